@@ -0,0 +1,28 @@
+import os
+import sys
+import argparse
+from utils import DragonflyMesh
+
+
+def convert_mesh(mesh_inpath, mesh_outpath, season=None):
+    
+    dragonflymesh = DragonflyMesh(mesh=mesh_inpath, season=season)
+    dragonflymesh.save(mesh_outpath)
+    
+    
+    
+
+
+
+if __name__ == '__main__':
+    
+    parser = argparse.ArgumentParser(description='Convert mesh data into the binary format.')
+   
+    parser.add_argument('-i', '--input', required=True)
+    parser.add_argument('-o', '--output', required=True)
+    parser.add_argument('--season', default=None, help='TSV file of month bitmasks')
+    args = parser.parse_args()
+    
+    convert_mesh(args.input, args.output, args.season)
+    
+
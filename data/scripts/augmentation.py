@@ -2,6 +2,7 @@ import os
 import sys
 import glob
 from imgutils import imgUtils
+from shardutils import ShardWriter
 import random
 import numpy as np
 from PIL import ImageFile
@@ -11,10 +12,13 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 
 
-def augment(input_dpath, output_dpath, output_prefix, n_images):
+def augment(input_dpath, output_dpath, output_prefix, n_images, output_format='png'):
     
     iu = imgUtils()
     
+    shard_writer = None
+    if output_format == 'shard':
+        shard_writer = ShardWriter(output_dpath)
     
     for dpath in sorted(glob.glob(os.path.join(input_dpath, '*'))):
         print(dpath)
@@ -22,12 +26,21 @@ def augment(input_dpath, output_dpath, output_prefix, n_images):
         np.random.seed(abs(hash(dpath)) % (10 ** 8))
         
         dname = os.path.basename(dpath)
+        if shard_writer is not None:
+            if os.path.isdir(dpath):
+                iu.augmentation(dpath, None, n=n_images, output_prefix=output_prefix, n_jobs=-1,
+                                shard_writer=shard_writer, label=dname)
+            continue
+        
         _output_dpath = os.path.join(output_dpath, dname)
         if not os.path.exists(_output_dpath):
             os.makedirs(_output_dpath)
             
         if os.path.isdir(dpath):
             iu.augmentation(dpath, _output_dpath, n=n_images, output_prefix=output_prefix, n_jobs=-1)
+    
+    if shard_writer is not None:
+        shard_writer.close()
 
   
 
@@ -40,7 +53,8 @@ if __name__ == '__main__':
     output_dpath = sys.argv[2]
     output_prefix = sys.argv[3]
     n_images = int(sys.argv[4])
-    augment(input_dpath, output_dpath, output_prefix, n_images)
+    output_format = sys.argv[5] if len(sys.argv) > 5 else 'png'
+    augment(input_dpath, output_dpath, output_prefix, n_images, output_format)
 
 
 
@@ -190,7 +190,8 @@ class imgUtils:
 
 
     
-    def augmentation(self, input_path=None, output_dirpath=None, n=100, output_prefix='augmented_image', n_jobs=-1):
+    def augmentation(self, input_path=None, output_dirpath=None, n=100, output_prefix='augmented_image', n_jobs=-1,
+                     shard_writer=None, label=None):
         
         if os.path.isfile(input_path):
             image_files = [input_path]
@@ -226,11 +227,22 @@ class imgUtils:
             img_ag = img_ag * 255
             img_ag = img_ag.astype(np.uint8)
             
-            new_file_path = os.path.join(output_dirpath, output_prefix + '_' + str(i) + '.png')
+            new_file_name = output_prefix + '_' + str(i) + '.png'
+            if shard_writer is not None:
+                # encode in the worker and write into the shard in the main process
+                return new_file_name, cv2.imencode('.png', cv2.cvtColor(img_ag, cv2.COLOR_RGB2BGR))[1].tobytes()
+            
+            new_file_path = os.path.join(output_dirpath, new_file_name)
             skimage.io.imsave(new_file_path, img_ag)
         
         
-        r = joblib.Parallel(n_jobs=n_jobs, verbose=0)([joblib.delayed(__augmentation_ss)(i + 1) for i in range(n)])
+        if shard_writer is None:
+            r = joblib.Parallel(n_jobs=n_jobs, verbose=0)([joblib.delayed(__augmentation_ss)(i + 1) for i in range(n)])
+        else:
+            for j in range(0, n, 256):
+                r = joblib.Parallel(n_jobs=n_jobs, verbose=0)([joblib.delayed(__augmentation_ss)(i + 1) for i in range(j, min(j + 256, n))])
+                for new_file_name, img_bytes in r:
+                    shard_writer.write(label, new_file_name, img_bytes)
 
 
 
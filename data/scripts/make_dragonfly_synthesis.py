@@ -11,6 +11,7 @@ import skimage.io
 import skimage.transform
 import skimage.filters
 import matplotlib.pyplot as plt
+from shardutils import ShardWriter
 
 from PIL import ImageFile
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -131,7 +132,8 @@ def add_noise(img):
 
 
 
-def synthesis(input_path=None, bg_path=None, output_dirpath=None, n=100, output_prefix='synthetic_image', n_jobs=-1):
+def synthesis(input_path=None, bg_path=None, output_dirpath=None, n=100, output_prefix='synthetic_image', n_jobs=-1,
+              shard_writer=None, label=None):
     
     mask_image_files = [os.path.join(input_path, f) for f in os.listdir(input_path) if os.path.isfile(os.path.join(input_path, f)) and (not f.startswith('.'))]
     
@@ -169,7 +171,12 @@ def synthesis(input_path=None, bg_path=None, output_dirpath=None, n=100, output_
                 img = img * 255
                 img = img.astype(np.uint8)
                 
-                new_file_path = os.path.join(output_dirpath, output_prefix + '_' + str(i) + '.png')
+                new_file_name = output_prefix + '_' + str(i) + '.png'
+                if shard_writer is not None:
+                    # encode in the worker and write into the shard in the main process
+                    return new_file_name, cv2.imencode('.png', cv2.cvtColor(img, cv2.COLOR_RGB2BGR))[1].tobytes()
+                
+                new_file_path = os.path.join(output_dirpath, new_file_name)
                 skimage.io.imsave(new_file_path, img)
                 
                 try_next = False
@@ -179,7 +186,13 @@ def synthesis(input_path=None, bg_path=None, output_dirpath=None, n=100, output_
                 print('faluire to synthesis image, try again.')
                 
     
-    r = joblib.Parallel(n_jobs=n_jobs, verbose=0)([joblib.delayed(__synthesis_ss)(i + 1) for i in range(n)])
+    if shard_writer is None:
+        r = joblib.Parallel(n_jobs=n_jobs, verbose=0)([joblib.delayed(__synthesis_ss)(i + 1) for i in range(n)])
+    else:
+        for j in range(0, n, 256):
+            r = joblib.Parallel(n_jobs=n_jobs, verbose=0)([joblib.delayed(__synthesis_ss)(i + 1) for i in range(j, min(j + 256, n))])
+            for new_file_name, img_bytes in r:
+                shard_writer.write(label, new_file_name, img_bytes)
 
 
 
@@ -187,23 +200,36 @@ def synthesis(input_path=None, bg_path=None, output_dirpath=None, n=100, output_
 
 
 
-def synthesis_main(mask_dirpath, bg_dirpath, output_dirpath, n_images):
+def synthesis_main(mask_dirpath, bg_dirpath, output_dirpath, n_images, output_format='png'):
     '''
     Synthesis images for training
     
     This function randomly samples a mask image of dragonfly and a background image,
     and synthesis both into one image.
+    If `output_format` is `shard`, images are written into tar shards.
     '''
     
+    shard_writer = None
+    if output_format == 'shard':
+        shard_writer = ShardWriter(output_dirpath)
+    
     for d in sorted(glob.glob(os.path.join(mask_dirpath, '*'))):
         print(d)
         
+        if shard_writer is not None:
+            synthesis(d, bg_dirpath, None, n=n_images, n_jobs=-1,
+                      shard_writer=shard_writer, label=os.path.basename(d))
+            continue
+        
         synimage_dirpath = os.path.join(output_dirpath, os.path.basename(d))
         
         if not os.path.exists(synimage_dirpath):
             os.makedirs(synimage_dirpath)
         
         synthesis(d, bg_dirpath, synimage_dirpath, n=n_images, n_jobs=-1)
+    
+    if shard_writer is not None:
+        shard_writer.close()
         
    
 
@@ -214,8 +240,9 @@ if __name__ == '__main__':
     bg_dpath = sys.argv[2]
     output_dpath = sys.argv[3]
     n_images = int(sys.argv[4])
+    output_format = sys.argv[5] if len(sys.argv) > 5 else 'png'
     
-    synthesis_main(mask_dpath, bg_dpath, output_dpath, n_images)
+    synthesis_main(mask_dpath, bg_dpath, output_dpath, n_images, output_format)
     
 
 
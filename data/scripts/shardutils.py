@@ -0,0 +1,74 @@
+import os
+import sys
+import io
+import glob
+import tarfile
+
+
+
+
+class ShardWriter:
+    '''
+    Write images into tar shards for training.
+
+    Images are appended into `shard-XXXXXX.tar` files in the output directory
+    as `<label>/<name>` members, and a new shard is started every `max_count`
+    images. The shard, member name, and label of every image are recorded in
+    `index.tsv`, so that the reader knows the dataset size and the labels
+    without scanning the shards. Shards written by previous runs are kept, so
+    that several scripts can write into the same directory.
+    '''
+
+
+    def __init__(self, output_dpath, max_count=10000):
+
+        self.output_dpath = output_dpath
+        self.max_count = max_count
+
+        if not os.path.exists(output_dpath):
+            os.makedirs(output_dpath)
+
+        self.shard_id = len(glob.glob(os.path.join(output_dpath, 'shard-*.tar')))
+        self.shard = None
+        self.count = 0
+        self.index = open(os.path.join(output_dpath, 'index.tsv'), 'a')
+
+
+    def __open_shard(self):
+        if self.shard is not None:
+            self.shard.close()
+        self.shard_name = 'shard-{:06d}.tar'.format(self.shard_id)
+        self.shard = tarfile.open(os.path.join(self.output_dpath, self.shard_name), 'w')
+        self.shard_id += 1
+        self.count = 0
+
+
+    def write(self, label, name, img_bytes):
+
+        if self.shard is None or self.count >= self.max_count:
+            self.__open_shard()
+
+        member_name = label + '/' + name
+        info = tarfile.TarInfo(member_name)
+        info.size = len(img_bytes)
+        self.shard.addfile(info, io.BytesIO(img_bytes))
+        self.index.write('{}\t{}\t{}\n'.format(self.shard_name, member_name, label))
+        self.count += 1
+
+
+    def close(self):
+        if self.shard is not None:
+            self.shard.close()
+            self.shard = None
+        self.index.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
@@ -0,0 +1,30 @@
+import os
+import sys
+import argparse
+from models import *
+
+
+def export(class_labels, model_arch, model_path, export_path, export_format):
+    
+    dragonfly = DragonflyCls(model_arch=model_arch, model_path=model_path, class_labels=class_labels, device='cpu')
+    dragonfly.export(export_path, export_format)
+    
+    
+    
+
+
+
+if __name__ == '__main__':
+    
+    parser = argparse.ArgumentParser(description='Let dragonfly fly!')
+   
+    parser.add_argument('--class-label', required=True)
+    parser.add_argument('--model-arch', required=True)
+    parser.add_argument('--model-weight', required=True)
+    parser.add_argument('--format', default='onnx', choices=['torchscript', 'onnx'])
+    parser.add_argument('-o', '--output', required=True)
+    args = parser.parse_args()
+    
+    export(args.class_label, args.model_arch, args.model_weight, args.output, args.format)
+    
+
@@ -5,7 +5,11 @@ import logging
 import coloredlogs
 import glob
 import copy
-import geopy.distance
+import random
+import tarfile
+import zipfile
+import inspect
+import json
 import torch
 import torchvision
 import numpy as np
@@ -13,7 +17,11 @@ import pandas as pd
 import cv2
 import PIL
 from PIL import Image
-from PIL import ExifTags
+from utils import n_available_cpus, load_labels, list_images, collect_predictions, imdecode, pad_resize, DragonflyHierarchy, DragonflyMesh
+try:
+    import safetensors.torch
+except ImportError:
+    safetensors = None
 
 
 logging.basicConfig(level = logging.INFO,
@@ -24,9 +32,9 @@ logging.basicConfig(level = logging.INFO,
 
 class DragonflySqueezenet(torch.nn.Module):
 
-    def __init__(self, n_classes):
+    def __init__(self, n_classes, pretrained=True):
         super(DragonflySqueezenet, self).__init__()
-        model = torchvision.models.squeezenet1_0(pretrained=True)
+        model = torchvision.models.squeezenet1_0(pretrained=pretrained)
         self.base = model
         self.base.classifier[1] = torch.nn.Conv2d(512, n_classes, kernel_size=(1, 1), stride=(1, 1))
         self.base.num_classes = n_classes
@@ -39,9 +47,9 @@ class DragonflySqueezenet(torch.nn.Module):
 
 class DragonflyMobilenet(torch.nn.Module):
     
-    def __init__(self, n_classes):
+    def __init__(self, n_classes, pretrained=True):
         super(DragonflyMobilenet, self).__init__()
-        model = torchvision.models.mobilenet_v2(pretrained=True)
+        model = torchvision.models.mobilenet_v2(pretrained=pretrained)
         model.classifier[1] = torch.nn.Linear(in_features=model.classifier[1].in_features, out_features=n_classes)
         self.base = model
         
@@ -54,9 +62,9 @@ class DragonflyMobilenet(torch.nn.Module):
 
 class DragonflyResnet(torch.nn.Module):
 
-    def __init__(self, n_classes):
+    def __init__(self, n_classes, pretrained=True):
         super(DragonflyResnet, self).__init__()
-        model = torchvision.models.resnet18(pretrained=True)
+        model = torchvision.models.resnet18(pretrained=pretrained)
         model.fc = torch.nn.Linear(model.fc.in_features, n_classes)
         self.base = model
     
@@ -69,9 +77,9 @@ class DragonflyResnet(torch.nn.Module):
 
 class DragonflyVGG(torch.nn.Module):
 
-    def __init__(self, n_classes):
+    def __init__(self, n_classes, pretrained=True):
         super(DragonflyVGG, self).__init__()
-        model =  torchvision.models.vgg11_bn(pretrained=True)
+        model =  torchvision.models.vgg11_bn(pretrained=pretrained)
         model.classifier[6] = torch.nn.Linear(model.classifier[6].in_features, n_classes)
         self.base = model
         
@@ -84,9 +92,9 @@ class DragonflyVGG(torch.nn.Module):
 
 class DragonflyResnet152(torch.nn.Module):
 
-    def __init__(self, n_classes):
+    def __init__(self, n_classes, pretrained=True):
         super(DragonflyResnet152, self).__init__()
-        model = torchvision.models.resnet152(pretrained=True)
+        model = torchvision.models.resnet152(pretrained=pretrained)
         model.fc = torch.nn.Linear(model.fc.in_features, n_classes)
         self.base = model
     
@@ -99,9 +107,9 @@ class DragonflyResnet152(torch.nn.Module):
 
 class DragonflyVGG19(torch.nn.Module):
 
-    def __init__(self, n_classes):
+    def __init__(self, n_classes, pretrained=True):
         super(DragonflyVGG19, self).__init__()
-        model =  torchvision.models.vgg19_bn(pretrained=True)
+        model =  torchvision.models.vgg19_bn(pretrained=pretrained)
         model.classifier[6] = torch.nn.Linear(model.classifier[6].in_features, n_classes)
         self.base = model
         
@@ -113,9 +121,9 @@ class DragonflyVGG19(torch.nn.Module):
 
 class DragonflyDensenet(torch.nn.Module):
 
-    def __init__(self, n_classes):
+    def __init__(self, n_classes, pretrained=True):
         super(DragonflyDensenet, self).__init__()
-        model =  torchvision.models.densenet121(pretrained=True)
+        model =  torchvision.models.densenet121(pretrained=pretrained)
         model.classifier = torch.nn.Linear(model.classifier.in_features, n_classes)
         self.base = model
 
@@ -139,29 +147,162 @@ class nnTorchResize():
         self.shape = shape
 
 
+    def resize(self, x):
+        """
+        Pad the image to a square and resize it, and return it as an array.
+        """
+        return pad_resize(x, self.shape)
+
+
     def __call__(self, x):
-        h, w, c = x.shape
-        longest_edge = max(h, w)
-        top = 0
-        bottom = 0
-        left = 0
-        right = 0
-        if h < longest_edge:
-            diff_h = longest_edge - h
-            top = diff_h // 2
-            bottom = diff_h - top
-        elif w < longest_edge:
-            diff_w = longest_edge - w
-            left = diff_w // 2
-            right = diff_w - left
+        x = self.resize(x)
+        x = PIL.Image.fromarray(x)
+        
+        return x
+
+
+
+
+
+class nnTorchValidTransform():
+    """
+    Transform for validation and inference without the PIL round-trip.
+    
+    Images are padded and resized by `nnTorchResize` in data loader workers,
+    and then converted from HWC uint8 arrays into normalized CHW float32
+    tensors in `collate`, which writes them into a preallocated batch tensor.
+    The values are identical to `ToTensor` and `Normalize` of torchvision.
+    The channels are kept in the BGR order of cv2, as the images for training.
+    """
+    
+    def __init__(self, shape=(224, 224), mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.shape = shape
+        self.resizer = nnTorchResize(shape)
+        self.mean = torch.tensor(mean, dtype=torch.float32).view(3, 1, 1)
+        self.std = torch.tensor(std, dtype=torch.float32).view(3, 1, 1)
+    
+    
+    def resize(self, x):
+        return self.resizer.resize(x)
+    
+    
+    def normalize(self, x, out=None):
+        x = torch.from_numpy(np.ascontiguousarray(x)).permute(2, 0, 1)
+        if out is None:
+            out = torch.empty(x.shape, dtype=torch.float32)
+        out.copy_(x)
+        out.div_(255).sub_(self.mean).div_(self.std)
+        return out
+    
+    
+    def __call__(self, x):
+        return self.normalize(self.resize(x))
+    
+    
+    def collate(self, batch):
+        has_labels = isinstance(batch[0], tuple)
+        xs = [b[0] for b in batch] if has_labels else batch
+        
+        inputs = torch.empty((len(xs), 3, xs[0].shape[0], xs[0].shape[1]), dtype=torch.float32)
+        for i, x in enumerate(xs):
+            self.normalize(x, out=inputs[i])
+        
+        if has_labels:
+            # labels, and latitudes, longitudes and months if the dataset returns them
+            targets = torch.utils.data.dataloader.default_collate([b[1:] for b in batch])
+            return (inputs, ) + tuple(targets)
+        return inputs
+
+
+
+
+
+class nnTorchImageCache():
+    """
+    On-disk cache of images padded and resized by `nnTorchResize`.
+    
+    The images are stored in a memory-mapped uint8 array of (n_images, h, w, 3)
+    with flags of cached rows, and indexed by path, size and mtime of the images.
+    Rows of modified images are invalidated when the cache is opened, and rows
+    are filled on the first access, so that images are decoded and resized once
+    over all epochs. Data loader workers share the cache through the file.
+    """
+    
+    def __init__(self, cache_dpath, x, shape=(224, 224)):
+        self.cache_dpath = cache_dpath
+        self.shape = tuple(shape)
+        self.resizer = nnTorchResize(self.shape)
+        self.images = None
+        self.flags = None
+        
+        if not os.path.exists(cache_dpath):
+            os.makedirs(cache_dpath)
+        
+        index = []
+        for fpath in x:
+            st = os.stat(fpath)
+            index.append('{}\t{}\t{}'.format(fpath, st.st_size, st.st_mtime_ns))
+        
+        index_fpath = os.path.join(cache_dpath, 'index.tsv')
+        prev_index = []
+        if os.path.exists(index_fpath):
+            with open(index_fpath, 'r') as infh:
+                prev_index = infh.read().split('\n')[:-1]
+        
+        prev_shape = None
+        if os.path.exists(os.path.join(cache_dpath, 'shape.json')):
+            with open(os.path.join(cache_dpath, 'shape.json'), 'r') as infh:
+                prev_shape = tuple(json.load(infh))
+        
+        has_memmaps = os.path.exists(os.path.join(cache_dpath, 'images.u8')) \
+                and os.path.exists(os.path.join(cache_dpath, 'flags.u8'))
+        if has_memmaps and len(prev_index) == len(index) and prev_shape == (len(index), ) + self.shape + (3, ) \
+                and [r.split('\t')[0] for r in prev_index] == list(x):
+            flags = np.memmap(os.path.join(cache_dpath, 'flags.u8'), mode='r+', dtype=np.uint8, shape=(len(index), ))
+            for i in range(len(index)):
+                if index[i] != prev_index[i]:
+                    flags[i] = 0
+            flags.flush()
+            del flags
+            logging.info('Opened the image cache at {}.'.format(cache_dpath))
         else:
-            pass
+            np.memmap(os.path.join(cache_dpath, 'images.u8'), mode='w+', dtype=np.uint8,
+                      shape=(max(len(index), 1), ) + self.shape + (3, )).flush()
+            np.memmap(os.path.join(cache_dpath, 'flags.u8'), mode='w+', dtype=np.uint8,
+                      shape=(max(len(index), 1), )).flush()
+            with open(os.path.join(cache_dpath, 'shape.json'), 'w') as outfh:
+                json.dump([len(index)] + list(self.shape) + [3], outfh)
+            logging.info('Created the image cache at {}.'.format(cache_dpath))
         
-        x = cv2.copyMakeBorder(x, top, bottom, left, right,
-                               cv2.BORDER_CONSTANT, value=[0, 0, 0])
-        x = cv2.resize(x, self.shape)
-        x = PIL.Image.fromarray(x)
+        with open(index_fpath, 'w') as outfh:
+            outfh.write(''.join(r + '\n' for r in index))
+        self.n_images = len(index)
+    
+    
+    def __open(self):
+        # open memory maps in each process
+        if self.images is None:
+            self.images = np.memmap(os.path.join(self.cache_dpath, 'images.u8'), mode='r+', dtype=np.uint8,
+                                    shape=(max(self.n_images, 1), ) + self.shape + (3, ))
+            self.flags = np.memmap(os.path.join(self.cache_dpath, 'flags.u8'), mode='r+', dtype=np.uint8,
+                                   shape=(max(self.n_images, 1), ))
+    
+    
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['images'] = None
+        state['flags'] = None
+        return state
+    
+    
+    def get(self, i, imread):
+        self.__open()
+        if self.flags[i] == 1:
+            return np.array(self.images[i])
         
+        x = self.resizer.resize(imread())
+        self.images[i] = x
+        self.flags[i] = 1
         return x
 
 
@@ -170,18 +311,58 @@ class nnTorchResize():
 
 class nnTorchDataset(torch.utils.data.Dataset):
 
-    def __init__(self, x, y=None, transforms=None):
+    def __init__(self, x, y=None, transforms=None, target_size=None, cache=None, gis=False):
         self.x = x
         self.y = y
         self.transforms = transforms
+        self.target_size = target_size
+        self.cache = cache
+        self.gis = gis
     
     
     def __len__(self):
         return len(self.x)
+    
+    
+    def imread(self, fpath):
+        # the file is read once, and the header and the image are decoded from the same buffer
+        with open(fpath, 'rb') as infh:
+            buf = infh.read()
+        
+        return imdecode(buf, self.target_size)
+    
+    
+    def imread_gis(self, fpath):
+        """
+        Read an image and the latitude, longitude and capture month recorded in
+        its EXIF. The file is opened only once; the header and the image are
+        decoded from the same buffer. Missing coordinates are set to NaN and
+        a missing month is set to 0.
+        """
+        with open(fpath, 'rb') as infh:
+            buf = infh.read()
+        
+        lat = np.nan
+        lng = np.nan
+        capture_date, _lat, _lng = DragonflyMesh.get_jpeg_info(buf)
+        if _lat is not None and _lng is not None:
+            lat = _lat
+            lng = _lng
+        month = 0
+        if capture_date is not None and capture_date[5:7].isdigit():
+            month = int(capture_date[5:7])
+        
+        x = imdecode(buf, self.target_size)
+        return x, lat, lng, month
 
 
     def __getitem__(self, i):
-        x = cv2.imread(self.x[i], cv2.IMREAD_COLOR)
+        if self.gis:
+            x, lat, lng, month = self.imread_gis(self.x[i])
+        elif self.cache is not None:
+            x = self.cache.get(i, lambda: self.imread(self.x[i]))
+        else:
+            x = self.imread(self.x[i])
         
         if self.transforms is not None:
             x = self.transforms(x)
@@ -189,6 +370,9 @@ class nnTorchDataset(torch.utils.data.Dataset):
         if self.y is None:
             return x
         
+        elif self.gis:
+            return x, self.y[i], lat, lng, month
+        
         else:
             y = self.y[i]
             return x, y
@@ -198,8 +382,134 @@ class nnTorchDataset(torch.utils.data.Dataset):
 
 
 
-class DragonflyCls():
+class nnTorchShardDataset(torch.utils.data.IterableDataset):
+    """
+    Dataset of images packed in tar shards by `data/scripts/shardutils.py`.
+    
+    The shards are read sequentially, and they are split among data loader
+    workers. If `shuffle` is True, the order of shards is shuffled in every
+    epoch, and images are drawn at random from up to `n_open_shards` shards
+    read at the same time and shuffled within a buffer of `buffer_size` images.
+    Since the scripts write images class by class, reading many shards at
+    the same time is required to mix classes in a batch.
+    Images whose labels are not in `class_labels` are skipped.
+    """
+    
+    def __init__(self, dataset_path, class_labels, transforms=None, shuffle=False, buffer_size=1000,
+                 n_open_shards=64):
+        self.dataset_path = dataset_path
+        self.transforms = transforms
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.n_open_shards = n_open_shards
+        self.class_index = {class_label: i for i, class_label in enumerate(class_labels)}
+        self.epoch = 0
+        
+        self.shards = []
+        self.shard_sizes = {}
+        self.n_images = 0
+        with open(os.path.join(dataset_path, 'index.tsv'), 'r') as infh:
+            for buf in infh:
+                shard, member_name, label = buf.rstrip('\n').split('\t')
+                if label in self.class_index:
+                    self.n_images += 1
+                    if shard not in self.shard_sizes:
+                        self.shards.append(shard)
+                        self.shard_sizes[shard] = 0
+                    self.shard_sizes[shard] += 1
+    
+    
+    def __len__(self):
+        return self.n_images
+    
+    
+    def __iter_shard(self, shard):
+        with tarfile.open(os.path.join(self.dataset_path, shard), 'r|') as tar:
+            for member in tar:
+                label = member.name.split('/')[0]
+                if (not member.isfile()) or (label not in self.class_index):
+                    continue
+                x = np.frombuffer(tar.extractfile(member).read(), dtype=np.uint8)
+                x = cv2.imdecode(x, cv2.IMREAD_COLOR)
+                if self.transforms is not None:
+                    x = self.transforms(x)
+                yield x, self.class_index[label]
+    
+    
+    def __iter_shards(self, shards):
+        """
+        Read up to `n_open_shards` shards at the same time, and draw the next image
+        from a shard chosen with the probability proportional to the number of
+        its remaining images, which makes a uniformly random merge of the shards.
+        """
+        shards = list(shards)
+        readers = []
+        remaining = []
+        while len(shards) > 0 or len(readers) > 0:
+            while len(shards) > 0 and len(readers) < self.n_open_shards:
+                shard = shards.pop(0)
+                readers.append(self.__iter_shard(shard))
+                remaining.append(self.shard_sizes[shard])
+            
+            i = random.choices(range(len(readers)), weights=remaining)[0]
+            try:
+                record = next(readers[i])
+            except StopIteration:
+                readers.pop(i)
+                remaining.pop(i)
+                continue
+            remaining[i] = max(remaining[i] - 1, 1)
+            yield record
+    
+    
+    def __iter__(self):
+        shards = list(self.shards)
+        worker_info = torch.utils.data.get_worker_info()
+        self.epoch += 1
+        if self.shuffle:
+            if worker_info is not None:
+                # all workers shuffle shards with the same seed, i.e., the base seed of
+                # the data loader (the seed of each worker is the base seed plus worker id),
+                # so that every shard is read by exactly one worker; the base seed is
+                # fixed across epochs for persistent workers, and thus the epoch counter
+                # of the dataset, which is kept in each worker, is mixed into the seed
+                seed = '{}-{}'.format(worker_info.seed - worker_info.id, self.epoch)
+                random.Random(seed).shuffle(shards)
+            else:
+                random.shuffle(shards)
+        
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+        
+        if not self.shuffle:
+            for shard in shards:
+                for record in self.__iter_shard(shard):
+                    yield record
+            return
+        
+        buffer = []
+        for record in self.__iter_shards(shards):
+            if len(buffer) < self.buffer_size:
+                buffer.append(record)
+            else:
+                i = random.randrange(len(buffer))
+                yield buffer[i]
+                buffer[i] = record
+        
+        random.shuffle(buffer)
+        for record in buffer:
+            yield record
+ 
+
 
+
+
+class DragonflyCls():
+    
+    # memory-mapped loading requires `mmap` of torch.load and `assign` of
+    # load_state_dict (PyTorch 2.1 or later)
+    MMAP_LOAD = ('mmap' in inspect.signature(torch.load).parameters and
+                 'assign' in inspect.signature(torch.nn.Module.load_state_dict).parameters)
     
     def __init__(self, model_arch='vgg', input_size=(224, 224), model_path=None, class_labels=None, device=None):
         
@@ -212,8 +522,9 @@ class DragonflyCls():
         
         # set model
         self.model_arch = model_arch
+        self.model_path = model_path
         self.input_size = input_size
-        self.class_labels = self.__generate_labels(class_labels)
+        self.class_labels = load_labels(class_labels)
         self.model = self.__initialize_model(model_arch, model_path)
         self.model.to(self.device)
         
@@ -240,28 +551,12 @@ class DragonflyCls():
                 torchvision.transforms.Normalize([0.485, 0.456, 0.406],
                                                  [0.229, 0.224, 0.225])])
         
-        self.transforms_valid = torchvision.transforms.Compose([
-                nnTorchResize(self.input_size),
-                torchvision.transforms.ToTensor(),
-                torchvision.transforms.Normalize([0.485, 0.456, 0.406],
-                                                 [0.229, 0.224, 0.225])])
+        self.transforms_valid = nnTorchValidTransform(self.input_size,
+                                                      [0.485, 0.456, 0.406],
+                                                      [0.229, 0.224, 0.225])
     
     
     
-    def __generate_labels(self, class_labels_fpath):
-        """
-        Load 1 column file that contains all labels.
-        """
-        
-        class_labels = []
-        
-        with open(class_labels_fpath, 'r') as infh:
-            for class_name in infh:
-                class_name = class_name.replace('\n', '')
-                if class_name != '':
-                    class_labels.append(class_name)
-        
-        return tuple(class_labels)
     
     
     
@@ -270,48 +565,125 @@ class DragonflyCls():
     def __initialize_model(self, model_arch=None, model_path=None):
         """
         Initialize a imagenet pre-trained model if the path to a model is not given,
-        otherwise, load the pre-trained model.
+        otherwise, load the pre-trained model. The imagenet weights are not
+        downloaded if the path to a model is given.
         """
         
+        pretrained = (model_path is None)
+        
+        if model_path is not None and self.MMAP_LOAD:
+            # parameters are not allocated nor initialized, since they are assigned from the checkpoint
+            with torch.device('meta'):
+                model = self.__build_model(model_arch, pretrained)
+        else:
+            model = self.__build_model(model_arch, pretrained)
+        
+        if model_path is not None:
+            self.__load_state_dict(model, model_path)
+            logging.info('Loaded the pre-trained model ({}).'.format(model_path))
+        
+        return model
+    
+    
+    def __build_model(self, model_arch, pretrained):
         model = None
         
         if model_arch == 'vgg':
-            model = DragonflyVGG(len(self.class_labels))
+            model = DragonflyVGG(len(self.class_labels), pretrained=pretrained)
         elif model_arch == 'vgg19':
-            model = DragonflyVGG19(len(self.class_labels))
+            model = DragonflyVGG19(len(self.class_labels), pretrained=pretrained)
         elif model_arch == 'resnet':
-            model = DragonflyResnet(len(self.class_labels))
+            model = DragonflyResnet(len(self.class_labels), pretrained=pretrained)
         elif model_arch == 'resnet152':
-            model = DragonflyResnet152(len(self.class_labels))
+            model = DragonflyResnet152(len(self.class_labels), pretrained=pretrained)
         elif model_arch == 'squeezenet':
-            model = DragonflySqueezenet(len(self.class_labels))
+            model = DragonflySqueezenet(len(self.class_labels), pretrained=pretrained)
         elif model_arch == 'mobilenet':
-            model = DragonflyMobilenet(len(self.class_labels))
+            model = DragonflyMobilenet(len(self.class_labels), pretrained=pretrained)
         elif model_arch == 'densenet':
-            model = DragonflyDensenet(len(self.class_labels))
+            model = DragonflyDensenet(len(self.class_labels), pretrained=pretrained)
         
+        return model
+    
+    
+    def __load_state_dict(self, model, model_path):
+        """
+        Load weights into the model through memory mapping.
         
-        if model_path is not None:
-            if self.device == 'cuda':
-                model.load_state_dict(torch.load(model_path))
-            else:
-                model.load_state_dict(torch.load(model_path, map_location=torch.device('cpu')))
-                
-            logging.info('Loaded the pre-trained model ({}).'.format(model_path))
+        With PyTorch 2.1 or later, checkpoints saved with safetensors (`.safetensors`)
+        or the zip format of `torch.save` are memory-mapped, and the tensors are
+        assigned to the model built on the meta device without copying, so that
+        processes on the same host share the page cache.
+        Older versions of PyTorch load the checkpoints in the ordinary way.
+        """
         
-        return model
+        if os.path.splitext(model_path)[1] == '.safetensors':
+            if safetensors is None:
+                raise ImportError('safetensors is required to load the model ({}).'.format(model_path))
+            state_dict = safetensors.torch.load_file(model_path, device='cpu')
+        elif self.MMAP_LOAD and zipfile.is_zipfile(model_path):
+            state_dict = torch.load(model_path, map_location=torch.device('cpu'), mmap=True)
+        else:
+            state_dict = torch.load(model_path, map_location=torch.device('cpu'))
+        
+        if self.MMAP_LOAD:
+            model.load_state_dict(state_dict, assign=True)
+        else:
+            model.load_state_dict(state_dict)
     
     
     
     
-    def __dataset_loader(self, dataset_path, load_mode=None, batch_size=32):
+    def dataloader_options(self, num_workers=4, pin_memory=False, prefetch_factor=2, persistent_workers=False):
+        """
+        Generate keyword arguments of DataLoader. If `num_workers` is `auto`,
+        the number of workers is set to the number of available CPU cores.
+        """
+        
+        if num_workers == 'auto':
+            num_workers = n_available_cpus()
+        num_workers = int(num_workers)
+        
+        options = {'num_workers': num_workers, 'pin_memory': pin_memory}
+        if num_workers > 0:
+            options['prefetch_factor'] = prefetch_factor
+            options['persistent_workers'] = persistent_workers
+        
+        return options
+    
+    
+    def __dataset_loader(self, dataset_path, load_mode=None, batch_size=32, cache_dpath=None, loader_options=None,
+                         gis=False):
         """
         If the path is specified to a directory, load all images from the given directory.
         If the path is specified to a file, load the single image.
+        A list of image paths can be also specified for inference.
+        If `gis` is True for inference, the latitudes and longitudes in EXIF are
+        also loaded from the same buffers of the images.
+        If the directory contains `index.tsv`, load images from the tar shards.
+        If the path to a cache directory is given for training or validation,
+        images padded and resized are cached in the directory (except for the
+        tar shards, which are read sequentially without the cache).
         """
         
+        if loader_options is None:
+            loader_options = self.dataloader_options()
+        
         dataset = None
-        if load_mode == 'train' or load_mode == 'valid':
+        if (load_mode == 'train' or load_mode == 'valid') and os.path.isfile(os.path.join(dataset_path, 'index.tsv')):
+            if load_mode == 'train':
+                dataset = nnTorchShardDataset(dataset_path, self.class_labels, transforms=self.transforms, shuffle=True)
+                dataset = torch.utils.data.DataLoader(dataset, batch_size=batch_size, **loader_options)
+            else:
+                dataset = nnTorchShardDataset(dataset_path, self.class_labels, transforms=self.transforms_valid.resize)
+                dataset = torch.utils.data.DataLoader(dataset, batch_size=batch_size,
+                                                      collate_fn=self.transforms_valid.collate, **loader_options)
+            
+            if cache_dpath is not None:
+                logging.warning('The image cache is not used for image shards; {} is ignored.'.format(cache_dpath))
+            logging.info('Loaded image shards from the directory {} for training.'.format(dataset_path))
+        
+        elif load_mode == 'train' or load_mode == 'valid':
             x = []
             y = []
             
@@ -321,30 +693,28 @@ class DragonflyCls():
                         x.append(fpath)
                         y.append(i)
             
+            cache = None
+            if cache_dpath is not None:
+                cache = nnTorchImageCache(cache_dpath, x, self.input_size)
+            
             if load_mode == 'train':
-                dataset = nnTorchDataset(x, y=y, transforms=self.transforms)
+                dataset = nnTorchDataset(x, y=y, transforms=self.transforms, target_size=self.input_size, cache=cache)
+                dataset = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True, **loader_options)
             else:
-                dataset = nnTorchDataset(x, y=y, transforms=self.transforms_valid)
+                dataset = nnTorchDataset(x, y=y, transforms=self.transforms_valid.resize, target_size=self.input_size, cache=cache)
+                dataset = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True,
+                                                      collate_fn=self.transforms_valid.collate, **loader_options)
                 
-            dataset = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4)
             logging.info('Loaded images from the directory {} for training.'.format(dataset_path))
         
         
         elif load_mode == 'inference':
-            x = []
-            y = []
-            if os.path.isfile(dataset_path):
-                x.append(dataset_path)
-                y.append(dataset_path)
-            else:
-                for fpath in os.listdir(dataset_path):
-                    if os.path.splitext(fpath)[1].lower() in ['.jpg', '.jpeg', '.png']:
-                        x.append(os.path.join(dataset_path, fpath))
-                        y.append(os.path.join(dataset_path, fpath))
-                
-            dataset = nnTorchDataset(x, y=y, transforms=self.transforms_valid)
-            dataset = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=4)
-            logging.info('Loaded images from the directory {} for inference.'.format(dataset_path))
+            x = list_images(dataset_path)
+            dataset = nnTorchDataset(x, y=x, transforms=self.transforms_valid.resize, target_size=self.input_size,
+                                     gis=gis)
+            dataset = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False,
+                                                  collate_fn=self.transforms_valid.collate, **loader_options)
+            logging.info('Loaded {} images for inference.'.format(len(x)))
         
         else:
             raise ValueError('Only `train`, `valid` or `inference` can be specified.')
@@ -506,11 +876,20 @@ class DragonflyCls():
         return superimposed_img
 
     
-    def train(self, train_data_dpath, valid_data_dpath, batch_size=32, num_epochs=50, learning_rate=0.0001, save_best=True):
+    def train(self, train_data_dpath, valid_data_dpath, batch_size=32, num_epochs=50, learning_rate=0.0001, save_best=True,
+              cache_dpath=None, num_workers=4, pin_memory=False, prefetch_factor=2, persistent_workers=False):
     
         # load dataset
-        train_dataset = self.__dataset_loader(train_data_dpath, load_mode='train', batch_size=batch_size)
-        valid_dataset = self.__dataset_loader(valid_data_dpath, load_mode='valid', batch_size=batch_size)
+        train_cache_dpath = None
+        valid_cache_dpath = None
+        if cache_dpath is not None:
+            train_cache_dpath = os.path.join(cache_dpath, 'train')
+            valid_cache_dpath = os.path.join(cache_dpath, 'valid')
+        loader_options = self.dataloader_options(num_workers, pin_memory, prefetch_factor, persistent_workers)
+        train_dataset = self.__dataset_loader(train_data_dpath, load_mode='train', batch_size=batch_size,
+                                              cache_dpath=train_cache_dpath, loader_options=loader_options)
+        valid_dataset = self.__dataset_loader(valid_data_dpath, load_mode='valid', batch_size=batch_size,
+                                              cache_dpath=valid_cache_dpath, loader_options=loader_options)
         
         dataloaders_dict = {'train': train_dataset, 'valid': valid_dataset}
     
@@ -527,171 +906,296 @@ class DragonflyCls():
     def save(self, model_path):
         
         # save model
-        torch.save(self.model.state_dict(), model_path)
+        if os.path.splitext(model_path)[1] == '.safetensors':
+            if safetensors is None:
+                raise ImportError('safetensors is required to save the model ({}).'.format(model_path))
+            state_dict = {k: v.contiguous() for k, v in self.model.state_dict().items()}
+            safetensors.torch.save_file(state_dict, model_path)
+        else:
+            torch.save(self.model.state_dict(), model_path)
         logging.info('The dragonfly is in a deep sleep at {}.'.format(model_path))
-        train_history_path = os.path.splitext(model_path)[0] + '.train_hisotry.tsv'
-        train_history_df = pd.DataFrame(self.train_history)
-        train_history_df.to_csv(train_history_path, sep='\t', index=False)
+        
+        if getattr(self, 'train_history', None) is not None:
+            train_history_path = os.path.splitext(model_path)[0] + '.train_hisotry.tsv'
+            train_history_df = pd.DataFrame(self.train_history)
+            train_history_df.to_csv(train_history_path, sep='\t', index=False)
         
     
-    def inference(self, data_path):
-        self.model.eval()
-        dataloader = self.__dataset_loader(data_path, load_mode='inference')
+    def export(self, export_path, export_format='torchscript'):
+        """
+        Export the model as a frozen TorchScript or ONNX graph for `DragonflyRuntime`.
         
-        file_names = []
-        pred_probs = None
+        Batch normalization layers are folded into convolutions while freezing
+        (TorchScript) or constant folding (ONNX). The class labels and input size
+        are saved into a JSON file next to the graph (`export_path` + `.json`).
+        """
+        
+        model = copy.deepcopy(self.model).to(torch.device('cpu'))
+        model.eval()
+        x = torch.zeros((1, 3) + tuple(self.input_size))
         
+        with torch.set_grad_enabled(False):
+            if export_format == 'torchscript':
+                model = torch.jit.trace(model, x)
+                if hasattr(torch.jit, 'freeze'):
+                    model = torch.jit.freeze(model)
+                torch.jit.save(model, export_path)
+            elif export_format == 'onnx':
+                torch.onnx.export(model, x, export_path, opset_version=11, do_constant_folding=True,
+                                  input_names=['input'], output_names=['output'],
+                                  dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}})
+            else:
+                raise ValueError('Only `torchscript` or `onnx` can be specified.')
+        
+        with open(export_path + '.json', 'w') as outfh:
+            json.dump({'model_arch': self.model_arch, 'format': export_format,
+                       'input_size': list(self.input_size), 'class_labels': list(self.class_labels)}, outfh)
+        
+        logging.info('The dragonfly is exported at {}.'.format(export_path))
+    
+    
+    def __quantizable_model(self):
+        """
+        Build a copy of the fp32 model with quantization stubs and fused modules
+        for the post-training static quantization.
+        """
+        
+        n_classes = len(self.class_labels)
+        
+        if self.model_arch in ['vgg', 'vgg19']:
+            model = torch.quantization.QuantWrapper(copy.deepcopy(self.model_fp32.base))
+            features = model.module.features
+            for i in range(len(features) - 2):
+                if isinstance(features[i], torch.nn.Conv2d) and isinstance(features[i + 1], torch.nn.BatchNorm2d) \
+                        and isinstance(features[i + 2], torch.nn.ReLU):
+                    torch.quantization.fuse_modules(features, [[str(i), str(i + 1), str(i + 2)]], inplace=True)
+            torch.quantization.fuse_modules(model.module.classifier, [['0', '1'], ['3', '4']], inplace=True)
+        
+        elif self.model_arch in ['resnet', 'resnet152']:
+            if self.model_arch == 'resnet':
+                block, layers = torchvision.models.quantization.resnet.QuantizableBasicBlock, [2, 2, 2, 2]
+            else:
+                block, layers = torchvision.models.quantization.resnet.QuantizableBottleneck, [3, 8, 36, 3]
+            model = torchvision.models.quantization.resnet.QuantizableResNet(block, layers, num_classes=n_classes)
+            model.load_state_dict(self.model_fp32.base.state_dict())
+            model.eval()
+            model.fuse_model()
+        
+        elif self.model_arch == 'mobilenet':
+            model = torchvision.models.quantization.QuantizableMobileNetV2(num_classes=n_classes)
+            model.load_state_dict(self.model_fp32.base.state_dict())
+            model.eval()
+            model.fuse_model()
+        
+        else:
+            raise ValueError('Static quantization only supports vgg, vgg19, resnet, resnet152, or mobilenet.')
+        
+        return model
+    
+    
+    def quantize(self, mode='dynamic', calibration_data_path=None, quantized_model_path=None, n_calibration_batches=10):
+        """
+        Convert the model into an int8 model for inference on CPU.
+        
+        The `dynamic` mode quantizes the weights of linear layers, and the `static`
+        mode quantizes both convolutional and linear layers with activation ranges
+        calibrated on the images in `calibration_data_path`.
+        The quantized model is saved as TorchScript to `quantized_model_path`
+        with the settings in a JSON file next to it (`quantized_model_path` + `.json`),
+        and is loaded from the file if it already exists and the settings
+        (mode, architecture, checkpoint and number of classes) are the same;
+        otherwise the model is quantized again and the file is overwritten.
+        The fp32 model is kept as `model_fp32` to validate the quantized model.
+        """
+        
+        if mode not in ['dynamic', 'static']:
+            raise ValueError('Only `dynamic` or `static` can be specified.')
+        
+        self.device = torch.device('cpu')
+        self.model_fp32 = self.model.to(self.device)
+        self.model_fp32.eval()
+        
+        quantization_info = {'mode': mode, 'model_arch': self.model_arch,
+                             'model_path': None, 'model_mtime_ns': None,
+                             'input_size': list(self.input_size), 'n_classes': len(self.class_labels)}
+        if self.model_path is not None:
+            quantization_info['model_path'] = os.path.abspath(self.model_path)
+            quantization_info['model_mtime_ns'] = os.stat(self.model_path).st_mtime_ns
+        
+        if quantized_model_path is not None and os.path.exists(quantized_model_path):
+            prev_quantization_info = None
+            if os.path.exists(quantized_model_path + '.json'):
+                with open(quantized_model_path + '.json', 'r') as infh:
+                    prev_quantization_info = json.load(infh)
+            if prev_quantization_info == quantization_info:
+                self.model = torch.jit.load(quantized_model_path, map_location=self.device)
+                logging.info('Loaded the quantized model ({}).'.format(quantized_model_path))
+                return
+            logging.warning('The quantized model ({}) does not match the current settings, '
+                            'and is quantized again.'.format(quantized_model_path))
+        
+        if mode == 'dynamic':
+            model = torch.quantization.quantize_dynamic(copy.deepcopy(self.model_fp32), {torch.nn.Linear}, dtype=torch.qint8)
+        
+        else:
+            if calibration_data_path is None:
+                raise ValueError('The calibration dataset is required for the static quantization.')
+            
+            model = self.__quantizable_model()
+            model.eval()
+            model.qconfig = torch.quantization.get_default_qconfig(torch.backends.quantized.engine)
+            torch.quantization.prepare(model, inplace=True)
+            
+            dataloader = self.__dataset_loader(calibration_data_path, load_mode='inference')
+            with torch.set_grad_enabled(False):
+                for i, (inputs, labels) in enumerate(dataloader):
+                    if i >= n_calibration_batches:
+                        break
+                    model(inputs)
+            torch.quantization.convert(model, inplace=True)
+        
+        model.eval()
+        self.model = torch.jit.trace(model, torch.zeros((1, 3) + tuple(self.input_size)))
+        logging.info('The model is quantized with the {} mode.'.format(mode))
+        
+        if quantized_model_path is not None:
+            torch.jit.save(self.model, quantized_model_path)
+            with open(quantized_model_path + '.json', 'w') as outfh:
+                json.dump(quantization_info, outfh)
+            logging.info('The quantized model is saved at {}.'.format(quantized_model_path))
+    
+    
+    def validate_quantization(self, data_path):
+        """
+        Calculate top-1 agreement between the fp32 and quantized models.
+        """
+        
+        if getattr(self, 'model_fp32', None) is None:
+            raise ValueError('The model has not been quantized.')
+        
+        dataloader = self.__dataset_loader(data_path, load_mode='inference')
+        
+        n_agree = 0
+        n_total = 0
         with torch.set_grad_enabled(False):
             for inputs, labels in dataloader:
                 inputs = inputs.to(self.device)
-                outputs = self.model(inputs)
-                outputs = torch.sigmoid(outputs).cpu().detach().numpy()
-                file_names.extend(labels)
-                if pred_probs is None:
-                    pred_probs = outputs
-                else:
-                    pred_probs = np.concatenate([pred_probs, outputs], axis=0)
+                pred_fp32 = torch.argmax(self.model_fp32(inputs), 1)
+                pred_int8 = torch.argmax(self.model(inputs), 1)
+                n_agree += torch.sum(pred_fp32 == pred_int8).item()
+                n_total += inputs.shape[0]
         
-        pred_probs = pd.DataFrame(pred_probs, index=file_names, columns=self.class_labels)
-        return pred_probs
+        agreement = n_agree / n_total if n_total > 0 else float('nan')
+        logging.info('Top-1 agreement between the fp32 and quantized models: {:.4f} ({}/{}).'.format(agreement, n_agree, n_total))
         
+        return agreement
+    
+    
+    def forward(self, inputs):
+        """
+        Calculate the probabilities of a batch tensor of images, and return
+        them as a float32 array.
+        """
+        self.model.eval()
+        with torch.set_grad_enabled(False):
+            outputs = self.model(inputs.to(self.device))
         
-
-class DragonflyMesh():
+        return torch.sigmoid(outputs).cpu().numpy()
     
-    def __init__(self, mesh):
-        self.dragonflymesh = self.__load_meshdata(mesh)
     
+    def __inference(self, dataloader, mesh=None, d=100):
+        for batch in dataloader:
+            probs = self.forward(batch[0])
+            if mesh is not None:
+                probs = mesh.filter_probs(probs, batch[2].numpy(), batch[3].numpy(), self.class_labels, d,
+                                          month=batch[4].numpy())
+            yield list(batch[1]), probs
     
-    def __load_meshdata(self, mesh):
-        x = pd.read_csv(mesh, header=0, sep='\t', index_col=0)
-        x.index = x.index.map(str)
+    
+    def inference_tensors(self, inputs):
+        """
+        Perform inference on a list of images which have been transformed by
+        `transforms_valid`, and return a float32 array of probabilities.
+        """
+        return self.forward(torch.stack(inputs, dim=0))
+    
+    
+    def iter_inference(self, data_path, batch_size=32, num_workers=4, pin_memory=False, prefetch_factor=2,
+                       mesh=None, d=100):
+        """
+        Perform inference batch by batch and yield a tuple of file names and
+        a float32 array of probabilities for each batch.
+        If `mesh` (DragonflyMesh) is given, the GPS coordinates are read in
+        the data loader workers from the same buffers as the images, and
+        the probabilities are masked by the presence within `d` km.
+        If a list of radii is given as `d`, the probabilities are masked for
+        each radius, and arrays of (n_images, n_radii, n_classes) are yielded.
+        """
+        loader_options = self.dataloader_options(num_workers, pin_memory, prefetch_factor)
+        dataloader = self.__dataset_loader(data_path, load_mode='inference', batch_size=batch_size,
+                                           loader_options=loader_options, gis=(mesh is not None))
+        for file_names, probs in self.__inference(dataloader, mesh, d):
+            yield file_names, probs
+    
+    
+    def inference(self, data_path, batch_size=32, num_workers=4, pin_memory=False, prefetch_factor=2,
+                  mesh=None, d=100):
+        img_fpaths = list_images(data_path)
+        batches = self.iter_inference(img_fpaths, batch_size, num_workers, pin_memory, prefetch_factor, mesh, d)
+        return collect_predictions(batches, len(img_fpaths), self.class_labels,
+                                   mesh.radii(d) if mesh is not None else None)
         
-        dmesh = {
-            'grid': x.iloc[:, :2],
-            'mesh': x.iloc[:, 2:]
-        }
         
-        return dmesh
+
+class DragonflyEnsemble(DragonflyCls):
+    """
+    Ensemble of image models that share one decoding and preprocessing pass.
     
+    Each batch of images is loaded once and fed to every model, and the
+    probabilities are combined by the arithmetic mean (`mean`) or geometric
+    mean (`gmean`), weighted by `weights` if given.
+    Images are loaded and predicted in the same way as `DragonflyCls`
+    except for the combination of the models in `forward`.
+    """
     
-    def __dataset_loader(self, data_path):
-        img_fpath = []
-        if os.path.isfile(data_path):
-            img_fpath.append(data_path)
-        else:
-            for fpath in os.listdir(data_path):
-                if os.path.splitext(fpath)[1].lower() in ['.jpg', '.jpeg', '.png']:
-                    img_fpath.append(os.path.join(data_path, fpath))
-        
-        return img_fpath
-    
-    
-    def gis2mesh(self, lat, lng, order = 3):
-        lat = float(lat)
-        lng = float(lng)
-        
-        lat_in_min = lat * 60.0
-        code12 = int(lat_in_min / 40)
-        lat_rest_in_min = lat_in_min - code12 * 40
-        code5 = int(lat_rest_in_min / 5 )
-        lat_rest_in_min -= code5 * 5
-        code7 = int(lat_rest_in_min / (5/10))
-
-        code34 = int(lng) - 100
-        lng_rest_in_deg = lng - int(lng)
-        code6 = int(lng_rest_in_deg * 8)
-        lng_rest_in_deg -= code6 / 8;
-        code8 = int(lng_rest_in_deg / (1/80) )
-        
-        code = code12 * 100 + code34
-        if order >= 2:
-            code = code * 100 + code5 * 10 + code6
-        if order == 3:
-            code = code * 100 + code7 * 10 + code8
-        
-        return str(int(code))
-    
-     
-    def get_jpeg_info(self, img_fpath):
-        lat = None
-        lng = None
-        capture_date = None
-        im = Image.open(img_fpath)
-
-        exif = im._getexif()
-
-        if exif is not None:
-            exif = {ExifTags.TAGS[k]: v for k, v in exif.items() if k in ExifTags.TAGS}
-            if 'GPSInfo' in exif:
-                gps_tags = exif['GPSInfo']
-                gps = {ExifTags.GPSTAGS.get(t, t): gps_tags[t] for t in gps_tags}
-                is_lat = 'GPSLatitude' in gps
-                is_lat_ref = 'GPSLatitudeRef' in gps
-                is_lon = 'GPSLongitude' in gps
-                is_lon_ref = 'GPSLongitudeRef' in gps
-
-                if is_lat and is_lat_ref and is_lon and is_lon_ref:
-                    lat = gps['GPSLatitude']
-                    lat_ref = gps['GPSLatitudeRef']
-                    if lat_ref == 'N':
-                        lat_sign = 1.0
-                    elif lat_ref == 'S':
-                        lat_sign = -1.0
-                    lon = gps['GPSLongitude']
-                    lon_ref = gps['GPSLongitudeRef']
-                    if lon_ref == 'E':
-                        lon_sign = 1.0
-                    elif lon_ref == 'W':
-                        lon_sign = -1.0
-                    lat = lat_sign * lat[0] + lat[1] / 60 + lat[2] / 3600
-                    lng = lon_sign * lon[0] + lon[1] / 60 + lon[2] / 3600
-        
-            if 'DateTimeOriginal' in exif:
-                capture_date = exif['DateTimeOriginal']
-                capture_date = capture_date.split(' ')[0].replace(':', '-')
-        return (capture_date, lat, lng)
-    
-    
-    def __calc_dist(self, x):
-        return geopy.distance.great_circle((x[0], x[1]), (x[2], x[3])).km
-        
-    
-    def __predict(self, gis, d=100):
-        gisdf =pd.DataFrame([gis] * self.dragonflymesh['grid'].shape[0],
-                            index=self.dragonflymesh['grid'].index, columns=['lat0', 'lng0'])
-        meshmat = pd.concat([self.dragonflymesh['grid'], gisdf], axis=1)
-        in_range = (meshmat.apply(self.__calc_dist, axis=1) < d)
-        output = self.dragonflymesh['mesh'].loc[in_range, :]
-        output = output.sum(axis=0)
-        output[output > 0] = 1
-        if not all(in_range):
-            output = output.fillna(1.0)
-        
-        return output
-    
-    
-    
-    def inference(self, data_path, d=100):
-        dataset = self.__dataset_loader(data_path)
-        pred_scores = None
-        for img_fpath in dataset:
-            capture_date, lat, lng = self.get_jpeg_info(img_fpath)
-            if lat is not None and lng is not None:
-                mesh = self.gis2mesh(lat, lng, 1)
-                pred_score = self.__predict((lat, lng), d)
-                pred_score = pd.DataFrame([pred_score.to_list()],
-                                           index=[img_fpath], columns=self.dragonflymesh['mesh'].columns)
-            else:
-                pred_score = pd.DataFrame([[1.0 for i in range(self.dragonflymesh['mesh'].shape[1])]],
-                                            index=[img_fpath], columns=self.dragonflymesh['mesh'].columns)
-            
-            if pred_scores is None:
-                pred_scores = pred_score
-            else:
-                pred_scores = pd.concat([pred_scores, pred_score], axis=0)
+    def __init__(self, models, class_labels=None, rule='mean', weights=None, input_size=(224, 224), device=None):
+        if rule not in ['mean', 'gmean']:
+            raise ValueError('Only `mean` or `gmean` can be specified.')
+        if weights is not None and len(weights) != len(models):
+            raise ValueError('The number of weights should be the same as the number of models.')
         
-        return pred_scores
+        self.models = []
+        for model_arch, model_path in models:
+            self.models.append(DragonflyCls(model_arch=model_arch, input_size=input_size, model_path=model_path,
+                                            class_labels=class_labels, device=device))
         
-
-
+        self.device = self.models[0].device
+        self.input_size = input_size
+        self.class_labels = self.models[0].class_labels
+        self.transforms_valid = self.models[0].transforms_valid
+        self.rule = rule
+        if weights is None:
+            weights = [1.0] * len(models)
+        self.weights = np.array(weights, dtype=np.float32) / np.sum(weights)
+    
+    
+    def forward(self, inputs):
+        """
+        Combine the probabilities of the models for a batch tensor of images.
+        """
+        inputs = inputs.to(self.device)
+        probs = None
+        with torch.set_grad_enabled(False):
+            for model, weight in zip(self.models, self.weights):
+                model.model.eval()
+                outputs = model.model(inputs)
+                if self.rule == 'mean':
+                    outputs = torch.sigmoid(outputs) * float(weight)
+                else:
+                    outputs = torch.nn.functional.logsigmoid(outputs) * float(weight)
+                probs = outputs if probs is None else probs + outputs
+        
+        if self.rule == 'gmean':
+            probs = torch.exp(probs)
+        
+        return probs.cpu().numpy()
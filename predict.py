@@ -1,22 +1,272 @@
 import os
 import sys
 import argparse
-import cv2
-from models import *
+import collections
+import shutil
+import tempfile
+import logging
+import numpy as np
+import pandas as pd
+from runtime import DragonflyRuntime
+from utils import list_images, DragonflyMesh, DragonflyHierarchy
 
 
+# `models` (torch and torchvision) is imported only when the image models are
+# loaded, so that the exported graphs can be used for prediction without torchvision
 
-def predict(model_arch, model_path, class_labels, inference_dataset, mesh=None, d=50):
+
+
+def load_dragonfly(model_arch, model_path, class_labels,
+                   quantize=None, calibration_dataset=None, quantized_model=None, quantization_validation=None,
+                   ensemble_rule='mean', ensemble_weights=None):
+    
+    # ensemble of several models given as lists
+    if isinstance(model_arch, (list, tuple)):
+        if len(model_arch) != len(model_path):
+            raise ValueError('The number of model architectures and weights should be the same.')
+        if len(model_arch) > 1:
+            if quantize is not None:
+                raise ValueError('Quantization is not supported for the ensemble of models.')
+            from models import DragonflyEnsemble
+            return DragonflyEnsemble(list(zip(model_arch, model_path)), class_labels=class_labels,
+                                     rule=ensemble_rule, weights=ensemble_weights, device='cpu')
+        model_arch = model_arch[0]
+        model_path = model_path[0]
+    
+    # graphs exported with export.py
+    if model_arch in ['onnx', 'torchscript']:
+        return DragonflyRuntime(model_path, class_labels=class_labels)
     
+    from models import DragonflyCls
     dragonfly = DragonflyCls(model_arch=model_arch, model_path=model_path, class_labels=class_labels, device='cpu')
-    probs = dragonfly.inference(inference_dataset)
     
+    if quantize is not None:
+        dragonfly.quantize(quantize, calibration_dataset, quantized_model)
+        if quantization_validation is not None:
+            dragonfly.validate_quantization(quantization_validation)
+    
+    return dragonfly
+
+
+
+def iter_predict(model_arch, model_path, class_labels, inference_dataset, mesh=None, d=50, mesh_cache_size=0,
+                 season=None, loader_options=None, **kwargs):
+    """
+    Perform prediction batch by batch. If the mesh data is given, GPS coordinates
+    are read together with the images, and each batch is masked by the presence
+    of the classes within `d` km. If a list of radii is given as `d`, a dict of
+    the results keyed by the radii is yielded for each batch. If the month
+    bitmasks are given as `season`, the classes are also filtered by the
+    capture month of each image.
+    """
+    
+    dragonfly = load_dragonfly(model_arch, model_path, class_labels, **kwargs)
+    if loader_options is None:
+        loader_options = {}
+    
+    dragonflymesh = None
     if mesh is not None:
-        dragonflymesh = DragonflyMesh(mesh=mesh)
-        mesh_output = dragonflymesh.inference(inference_dataset, d=d)
-        probs = probs * mesh_output
+        dragonflymesh = DragonflyMesh(mesh=mesh, cache_size=mesh_cache_size, season=season)
+    
+    for file_names, probs in dragonfly.iter_inference(inference_dataset, mesh=dragonflymesh, d=d, **loader_options):
+        if probs.ndim == 3:
+            yield collections.OrderedDict((r, pd.DataFrame(probs[:, i], index=file_names, columns=dragonfly.class_labels))
+                                          for i, r in enumerate(dragonflymesh.radii(d)))
+        else:
+            yield pd.DataFrame(probs, index=file_names, columns=dragonfly.class_labels, copy=False)
+    
+    if dragonflymesh is not None and mesh_cache_size > 0:
+        logging.info('Mesh cache: hits {}; misses {}.'.format(dragonflymesh.cache_hits, dragonflymesh.cache_misses))
+
+
+
+def predict(model_arch, model_path, class_labels, inference_dataset, mesh=None, d=50, mesh_cache_size=0,
+            season=None, loader_options=None, **kwargs):
+    
+    dragonfly = load_dragonfly(model_arch, model_path, class_labels, **kwargs)
+    if loader_options is None:
+        loader_options = {}
+    
+    dragonflymesh = None
+    if mesh is not None:
+        dragonflymesh = DragonflyMesh(mesh=mesh, cache_size=mesh_cache_size, season=season)
+    
+    probs = dragonfly.inference(inference_dataset, mesh=dragonflymesh, d=d, **loader_options)
+    if isinstance(probs, tuple):
+        file_names, probs = probs
+        probs = collections.OrderedDict((r, pd.DataFrame(probs[:, i], index=file_names, columns=dragonfly.class_labels))
+                                        for i, r in enumerate(dragonflymesh.radii(d)))
+    
+    if dragonflymesh is not None and mesh_cache_size > 0:
+        logging.info('Mesh cache: hits {}; misses {}.'.format(dragonflymesh.cache_hits, dragonflymesh.cache_misses))
     
     return probs
+
+
+
+def radius_output(output, d):
+    """
+    Insert the radius into the name of the output file (e.g., `inf_probs.d50.txt`)
+    to write the results of several radii into separate files.
+    """
+    
+    root, ext = os.path.splitext(output)
+    return '{}.d{}{}'.format(root, d, ext)
+
+
+
+def load_manifest(manifest):
+    """
+    Load the manifest of processed files, which records path, size and mtime
+    of every file whose prediction result has been written into the output.
+    """
+    
+    processed_files = {}
+    if os.path.exists(manifest):
+        with open(manifest, 'r') as infh:
+            for buf in infh:
+                buf = buf.rstrip('\n').split('\t')
+                if len(buf) == 3:
+                    processed_files[buf[0]] = (int(buf[1]), int(buf[2]))
+    
+    return processed_files
+
+
+
+def file_stat(fpath):
+    st = os.stat(fpath)
+    return (st.st_size, st.st_mtime_ns)
+
+
+
+def incremental_predict(model_arch, model_path, class_labels, inference_dataset, output,
+                        mesh=None, d=50, mesh_cache_size=0, genus_output=None, hierarchy=None, **kwargs):
+    """
+    Perform prediction only for new or modified files in the dataset.
+    
+    The processed files are recorded in the manifest (`output` + `.manifest.tsv`)
+    after each batch is written, so that an interrupted run resumes from
+    the last completed batch. Rows of files which have been written into the
+    existing outputs again (modified files, files written before the manifest,
+    or files whose manifest lines were lost by an interruption) are replaced
+    with the latest results.
+    If `genus_output` is given, genus scores derived by `hierarchy` are also
+    written incrementally.
+    """
+    
+    manifest = output + '.manifest.tsv'
+    processed_files = load_manifest(manifest)
+    
+    img_fpaths = []
+    img_fstats = {}
+    n_modified = 0
+    for fpath in list_images(inference_dataset):
+        img_fstats[fpath] = file_stat(fpath)
+        if fpath not in processed_files:
+            img_fpaths.append(fpath)
+        elif processed_files[fpath] != img_fstats[fpath]:
+            img_fpaths.append(fpath)
+            n_modified += 1
+    
+    logging.info('{} images have been processed; {} new and {} modified images will be processed.'.format(
+        len(processed_files), len(img_fpaths) - n_modified, n_modified))
+    if len(img_fpaths) == 0:
+        return
+    
+    outputs = [output] if genus_output is None else [output, genus_output]
+    if mesh is not None:
+        if DragonflyMesh.radii(d) is not None:
+            outputs = [radius_output(_output, r) for _output in outputs for r in DragonflyMesh.radii(d)]
+    existing_outputs = [_output for _output in outputs if os.path.exists(_output)]
+    
+    batches = iter_predict(model_arch, model_path, class_labels, img_fpaths, mesh, d, mesh_cache_size, **kwargs)
+    if genus_output is not None:
+        batches = iter_write_predictions(batches, genus_output, append=True, transform=hierarchy)
+    with open(manifest, 'a') as manifestfh:
+        for probs in iter_write_predictions(batches, output, append=True):
+            if isinstance(probs, dict):
+                probs = next(iter(probs.values()))
+            for fpath in probs.index:
+                manifestfh.write('{}\t{}\t{}\n'.format(fpath, *img_fstats[fpath]))
+            manifestfh.flush()
+    
+    # keep only the latest results of the files written into the existing outputs again
+    for _output in existing_outputs:
+        remove_duplicated_rows(_output)
+
+
+
+def remove_duplicated_rows(output, chunksize=10000):
+    """
+    Remove rows of duplicated file names from an output file, keeping the last ones.
+    
+    Only the file names are read to find the duplicates, and the file is
+    rewritten chunk by chunk only if any duplicates are found. The rows are
+    written into a temporary file in the same directory, which replaces the
+    output file once it is complete, so that no rows are lost by an interruption.
+    """
+    
+    fpaths = pd.read_csv(output, header=0, usecols=[0], dtype=str, keep_default_na=False, sep='\t').iloc[:, 0]
+    is_kept = ~fpaths.duplicated(keep='last').values
+    if np.all(is_kept):
+        return
+    
+    outfh = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(output)),
+                                        prefix=os.path.basename(output) + '.', suffix='.tmp', delete=False)
+    try:
+        with outfh:
+            i = 0
+            for probs in pd.read_csv(output, header=0, index_col=0, sep='\t', chunksize=chunksize):
+                probs[is_kept[i:i + probs.shape[0]]].to_csv(outfh, header=(i == 0), index=True, sep='\t')
+                i += probs.shape[0]
+        shutil.copymode(output, outfh.name)
+        os.replace(outfh.name, output)
+    except BaseException:
+        os.remove(outfh.name)
+        raise
+    
+    logging.info('Removed {} duplicated rows from {}.'.format(np.sum(~is_kept), output))
+
+
+
+def iter_write_predictions(batches, output, append=False, transform=None):
+    """
+    Write prediction results batch by batch, so that the rows of the finished
+    batches are kept in the output file even if the process is interrupted.
+    Each batch is yielded after it has been flushed to the output file.
+    If `transform` is given, the transformed results (e.g., genus scores
+    derived by DragonflyHierarchy) are written instead, and the original
+    batches are yielded.
+    If the batches are dicts of results keyed by radii, the results of each
+    radius are written into the file named by `radius_output`.
+    If `append` is True, the results are appended to the existing files.
+    """
+    
+    outfhs = {}
+    write_header = {}
+    try:
+        for probs in batches:
+            for d, _probs in (probs.items() if isinstance(probs, dict) else [(None, probs)]):
+                if d not in outfhs:
+                    fpath = output if d is None else radius_output(output, d)
+                    _append = append and os.path.exists(fpath)
+                    outfhs[d] = open(fpath, 'a' if _append else 'w')
+                    write_header[d] = not _append
+                if transform is not None:
+                    _probs = transform(_probs)
+                _probs.to_csv(outfhs[d], header=write_header[d], index=True, sep='\t')
+                outfhs[d].flush()
+                write_header[d] = False
+            yield probs
+    finally:
+        for outfh in outfhs.values():
+            outfh.close()
+
+
+
+def write_predictions(batches, output, append=False):
+    for probs in iter_write_predictions(batches, output, append):
+        pass
     
 
 
@@ -27,24 +277,82 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Let dragonfly fly!')
 
     parser.add_argument('--class-label', required=True)
-    parser.add_argument('--model-arch', required=True)
-    parser.add_argument('--model-weight', required=True)
+    parser.add_argument('--model-arch', required=True, nargs='+')
+    parser.add_argument('--model-weight', required=True, nargs='+')
+    parser.add_argument('--ensemble-rule', default='mean', choices=['mean', 'gmean'])
+    parser.add_argument('--ensemble-weights', default=None, nargs='+', type=float)
     parser.add_argument('--mesh', default=None)
-    parser.add_argument('-d', default=50, type=int)
+    parser.add_argument('-d', default=[50], type=int, nargs='+',
+                        help='radius (km) of the mesh filtering; results are written for each radius if several are given')
+    parser.add_argument('--mesh-cache-size', default=0, type=int)
+    parser.add_argument('--season', default=None, help='TSV file of month bitmasks of the mesh data')
     parser.add_argument('-i', '--inference-dataset', default=None)
+    parser.add_argument('-b', '--batch-size', default=32, type=int)
+    parser.add_argument('--num-workers', default='4', help='number of DataLoader workers or `auto`')
+    parser.add_argument('--pin-memory', action='store_true')
+    parser.add_argument('--prefetch-factor', default=2, type=int)
     parser.add_argument('-o', '--output', default=None)
     parser.add_argument('--overwrite', action='store_true')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--genus-output', default=None)
+    parser.add_argument('--genus-label', default=None)
+    parser.add_argument('--genus-rule', default='max', choices=['max', 'noisyor'])
+    parser.add_argument('--quantize', default=None, choices=['dynamic', 'static'])
+    parser.add_argument('--calibration-dataset', default=None)
+    parser.add_argument('--quantized-model', default=None)
+    parser.add_argument('--quantization-validation', default=None)
     
     args = parser.parse_args()
+    d = args.d[0] if len(args.d) == 1 else args.d
     
-    probs = predict(args.model_arch, args.model_weight, args.class_label,
-                    args.inference_dataset, args.mesh, args.d)
-    if args.output is None:
-        print(probs)
-    else:
-        if args.overwrite and os.path.exists(args.output):
-            probs.to_csv(args.output, header=False, index=True, sep='\t', mode='a')
+    model_options = {
+        'quantize': args.quantize,
+        'calibration_dataset': args.calibration_dataset,
+        'quantized_model': args.quantized_model,
+        'quantization_validation': args.quantization_validation,
+        'ensemble_rule': args.ensemble_rule,
+        'ensemble_weights': args.ensemble_weights,
+        'season': args.season,
+        'loader_options': {
+            'batch_size': args.batch_size,
+            'num_workers': args.num_workers,
+            'pin_memory': args.pin_memory,
+            'prefetch_factor': args.prefetch_factor
+        }
+    }
+    
+    if args.incremental:
+        if args.output is None:
+            raise ValueError('The output file should be specified with `-o` in the incremental mode.')
+        hierarchy = None
+        if args.genus_output is not None:
+            hierarchy = DragonflyHierarchy(args.genus_label, args.genus_rule)
+        incremental_predict(args.model_arch, args.model_weight, args.class_label,
+                            args.inference_dataset, args.output, args.mesh, d, args.mesh_cache_size,
+                            args.genus_output, hierarchy, **model_options)
+    elif args.output is None:
+        probs = predict(args.model_arch, args.model_weight, args.class_label,
+                        args.inference_dataset, args.mesh, d, args.mesh_cache_size, **model_options)
+        if isinstance(probs, dict):
+            for r, _probs in probs.items():
+                print('d = {} km'.format(r))
+                print(_probs)
+                if args.genus_output is not None:
+                    genus_probs = DragonflyHierarchy(args.genus_label, args.genus_rule)(_probs)
+                    genus_probs.to_csv(radius_output(args.genus_output, r), header=True, index=True, sep='\t')
         else:
-            probs.to_csv(args.output, header=True, index=True, sep='\t')
+            print(probs)
+            if args.genus_output is not None:
+                genus_probs = DragonflyHierarchy(args.genus_label, args.genus_rule)(probs)
+                genus_probs.to_csv(args.genus_output, header=True, index=True, sep='\t')
+    else:
+        batches = iter_predict(args.model_arch, args.model_weight, args.class_label,
+                               args.inference_dataset, args.mesh, d, args.mesh_cache_size, **model_options)
+        if args.genus_output is not None:
+            batches = iter_write_predictions(batches, args.genus_output,
+                                             append=args.overwrite,
+                                             transform=DragonflyHierarchy(args.genus_label, args.genus_rule))
+        write_predictions(batches, args.output,
+                          append=args.overwrite)
 
 
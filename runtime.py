@@ -0,0 +1,124 @@
+import sys
+import json
+import logging
+import concurrent.futures
+import numpy as np
+from utils import npResize, n_available_cpus, load_labels, list_images, collect_predictions, imdecode
+
+
+logging.basicConfig(level = logging.INFO,
+                    format = '[%(asctime)s] %(levelname)s: %(message)s',
+                    datefmt = '%Y-%m-%d %H:%M:%S')
+
+
+
+class DragonflyRuntime():
+    """
+    Inference engine for the graphs exported by `DragonflyCls.export`.
+
+    ONNX graphs are run with ONNX Runtime and TorchScript graphs are run with
+    PyTorch, and neither of them requires torchvision.
+    """
+
+    def __init__(self, model_path, class_labels=None, n_jobs=4):
+
+        with open(model_path + '.json', 'r') as infh:
+            meta = json.load(infh)
+
+        self.model_arch = meta['model_arch']
+        self.export_format = meta['format']
+        self.input_size = tuple(meta['input_size'])
+        if class_labels is None:
+            self.class_labels = tuple(meta['class_labels'])
+        else:
+            self.class_labels = load_labels(class_labels)
+        self.n_jobs = n_jobs
+        self.transforms_valid = npResize(self.input_size)
+
+        if self.export_format == 'onnx':
+            import onnxruntime
+            self.session = onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider'])
+            self.input_name = self.session.get_inputs()[0].name
+        elif self.export_format == 'torchscript':
+            import torch
+            self.torch = torch
+            self.session = torch.jit.load(model_path, map_location=torch.device('cpu'))
+            self.session.eval()
+        else:
+            raise ValueError('Unsupported format of the exported model ({}).'.format(self.export_format))
+
+        logging.info('Loaded the exported model ({}).'.format(model_path))
+
+
+    def __load_image(self, img_fpath, mesh=None):
+        # the file is read once, and the header (image size and EXIF) and the image
+        # are decoded from the same buffer
+        with open(img_fpath, 'rb') as infh:
+            buf = infh.read()
+        
+        lat = np.nan
+        lng = np.nan
+        month = 0
+        if mesh is not None:
+            capture_date, _lat, _lng = mesh.get_jpeg_info(buf)
+            if _lat is not None and _lng is not None:
+                lat = _lat
+                lng = _lng
+            if capture_date is not None and capture_date[5:7].isdigit():
+                month = int(capture_date[5:7])
+        
+        # decode JPEG with the largest reduction keeping the input size, as nnTorchDataset
+        x = self.transforms_valid(imdecode(buf, self.input_size))
+        return x, lat, lng, month
+    
+    
+    def __forward(self, inputs):
+        if self.export_format == 'onnx':
+            outputs = self.session.run(None, {self.input_name: inputs})[0]
+        else:
+            with self.torch.no_grad():
+                outputs = self.session(self.torch.from_numpy(inputs)).numpy()
+
+        return (1 / (1 + np.exp(-outputs))).astype(np.float32)
+
+
+    def iter_inference(self, data_path, batch_size=32, num_workers=None, mesh=None, d=100, **kwargs):
+        """
+        Perform inference batch by batch and yield a tuple of file names and
+        a float32 array of probabilities for each batch.
+        Images are loaded with `num_workers` threads (`n_jobs` if not given,
+        or the number of available CPU cores if `auto`). Other options of DataLoader
+        are accepted for the compatibility with `DragonflyCls` and ignored.
+        If `mesh` (DragonflyMesh) is given, the probabilities are masked by
+        the presence within `d` km from the GPS coordinates of the images,
+        or for each radius if a list of radii is given.
+        """
+        dataset = list_images(data_path)
+
+        if num_workers is None:
+            num_workers = self.n_jobs
+        elif num_workers == 'auto':
+            num_workers = n_available_cpus()
+        num_workers = max(int(num_workers), 1)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for i in range(0, len(dataset), batch_size):
+                file_names = dataset[i:(i + batch_size)]
+                images = list(executor.map(lambda fpath: self.__load_image(fpath, mesh), file_names))
+                inputs = np.stack([x for x, lat, lng, month in images], axis=0)
+                probs = self.__forward(inputs)
+                if mesh is not None:
+                    probs = mesh.filter_probs(probs, [lat for x, lat, lng, month in images],
+                                              [lng for x, lat, lng, month in images], self.class_labels, d,
+                                              month=[month for x, lat, lng, month in images])
+                yield file_names, probs
+
+
+    def inference(self, data_path, batch_size=32, num_workers=None, mesh=None, d=100, **kwargs):
+        dataset = list_images(data_path)
+        batches = self.iter_inference(dataset, batch_size=batch_size, num_workers=num_workers, mesh=mesh, d=d)
+        return collect_predictions(batches, len(dataset), self.class_labels,
+                                   mesh.radii(d) if mesh is not None else None)
+
+
+
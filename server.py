@@ -0,0 +1,201 @@
+import os
+import sys
+import json
+import time
+import queue
+import threading
+import argparse
+import urllib.parse
+import http.server
+import cv2
+from models import *
+from utils import imdecode
+
+
+
+class DragonflyServer():
+    """
+    Keep the models resident and batch concurrent requests.
+    
+    Requests are queued and collected by a single worker thread, until the
+    batch reaches `max_batch_size` or `max_latency` (seconds) has passed since
+    the first request of the batch, and then the batch is classified with one
+    forward pass.
+    """
+    
+    def __init__(self, dragonfly, dragonflymesh=None, d=50, max_batch_size=32, max_latency=0.01):
+        self.dragonfly = dragonfly
+        self.dragonflymesh = dragonflymesh
+        self.d = d
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.__batch_worker, daemon=True)
+        self.worker.start()
+    
+    
+    def __batch_worker(self):
+        while True:
+            requests = [self.queue.get()]
+            deadline = time.time() + self.max_latency
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            
+            try:
+                probs = self.dragonfly.inference_tensors([r['input'] for r in requests])
+                if self.dragonflymesh is not None:
+                    probs = self.dragonflymesh.filter_probs(probs, [r['lat'] for r in requests],
+                                                            [r['lng'] for r in requests],
+                                                            self.dragonfly.class_labels, self.d,
+                                                            month=[r['month'] for r in requests])
+                for r, _probs in zip(requests, probs):
+                    r['probs'] = _probs
+            except Exception as e:
+                for r in requests:
+                    r['error'] = e
+            finally:
+                for r in requests:
+                    r['done'].set()
+    
+    
+    def predict(self, img_bytes, lat=None, lng=None):
+        """
+        Predict an image given as encoded bytes, and return a float32 array of probabilities.
+        The image is decoded and transformed in the calling thread.
+        If the latitude and longitude are not given, those recorded in EXIF are used
+        as `predict.py`, and the capture month in EXIF is used for the mesh filtering.
+        """
+        if len(img_bytes) == 0:
+            raise ValueError('The image is empty.')
+        
+        month = 0
+        if self.dragonflymesh is not None:
+            capture_date, _lat, _lng = self.dragonflymesh.get_jpeg_info(img_bytes)
+            if lat is None and lng is None and _lat is not None and _lng is not None:
+                lat = _lat
+                lng = _lng
+            if capture_date is not None and capture_date[5:7].isdigit():
+                month = int(capture_date[5:7])
+        
+        try:
+            img = imdecode(img_bytes, self.dragonfly.input_size)
+        except cv2.error:
+            img = None
+        if img is None:
+            raise ValueError('The image cannot be decoded.')
+        
+        request = {
+            'input': self.dragonfly.transforms_valid(img),
+            'lat': np.nan if lat is None else float(lat),
+            'lng': np.nan if lng is None else float(lng),
+            'month': month,
+            'done': threading.Event(),
+            'probs': None,
+            'error': None
+        }
+        self.queue.put(request)
+        request['done'].wait()
+        
+        if request['error'] is not None:
+            raise request['error']
+        return request['probs']
+
+
+
+def make_handler(server):
+    
+    class DragonflyHandler(http.server.BaseHTTPRequestHandler):
+        
+        def __send_json(self, status, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        
+        def do_GET(self):
+            if urllib.parse.urlparse(self.path).path == '/health':
+                self.__send_json(200, {'status': 'ok'})
+            else:
+                self.__send_json(404, {'error': 'Not found.'})
+        
+        
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+            if url.path != '/predict':
+                self.__send_json(404, {'error': 'Not found.'})
+                return
+            
+            params = urllib.parse.parse_qs(url.query)
+            lat = params['lat'][0] if 'lat' in params else None
+            lng = params['lng'][0] if 'lng' in params else None
+            
+            try:
+                img_bytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                probs = server.predict(img_bytes, lat, lng)
+            except ValueError as e:
+                self.__send_json(400, {'error': str(e)})
+                return
+            except Exception as e:
+                logging.error('Prediction failed: {}'.format(e))
+                self.__send_json(500, {'error': 'Prediction failed.'})
+                return
+            
+            self.__send_json(200, {'probs': dict(zip(server.dragonfly.class_labels, probs.tolist()))})
+        
+        
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+    
+    return DragonflyHandler
+
+
+
+def serve(model_arch, model_path, class_labels, mesh=None, d=50, mesh_cache_size=0,
+          host='127.0.0.1', port=8000, max_batch_size=32, max_latency=0.01, season=None):
+    
+    dragonfly = DragonflyCls(model_arch=model_arch, model_path=model_path, class_labels=class_labels, device='cpu')
+    dragonflymesh = None
+    if mesh is not None:
+        dragonflymesh = DragonflyMesh(mesh=mesh, cache_size=mesh_cache_size, season=season)
+    
+    server = DragonflyServer(dragonfly, dragonflymesh, d, max_batch_size, max_latency)
+    httpd = http.server.ThreadingHTTPServer((host, port), make_handler(server))
+    logging.info('The dragonfly is waiting at http://{}:{}/predict.'.format(host, port))
+    httpd.serve_forever()
+    
+
+
+
+    
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Let dragonfly fly!')
+
+    parser.add_argument('--class-label', required=True)
+    parser.add_argument('--model-arch', required=True)
+    parser.add_argument('--model-weight', required=True)
+    parser.add_argument('--mesh', default=None)
+    parser.add_argument('-d', default=50, type=int)
+    parser.add_argument('--mesh-cache-size', default=0, type=int)
+    parser.add_argument('--season', default=None, help='TSV file of month bitmasks of the mesh data')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--max-batch-size', default=32, type=int)
+    parser.add_argument('--max-latency', default=10, type=float, help='in milliseconds')
+    
+    args = parser.parse_args()
+    
+    serve(args.model_arch, args.model_weight, args.class_label, args.mesh, args.d, args.mesh_cache_size,
+          args.host, args.port, args.max_batch_size, args.max_latency / 1000, args.season)
+
+
@@ -6,12 +6,15 @@ from models import *
 
 def train(class_labels, model_arch, model_inpath, model_outpath,
           traindata, validdata,
-          epochs, batch_size, lr):
+          epochs, batch_size, lr, cache=None,
+          num_workers=4, pin_memory=False, prefetch_factor=2, persistent_workers=False):
     
     dragonfly = DragonflyCls(model_arch=model_arch, input_size=(224, 224), model_path=model_inpath, class_labels=class_labels)
     
     dragonfly.train(traindata, validdata,
-                    batch_size=batch_size, num_epochs=epochs, learning_rate=lr, save_best=False)
+                    batch_size=batch_size, num_epochs=epochs, learning_rate=lr, save_best=False,
+                    cache_dpath=cache, num_workers=num_workers, pin_memory=pin_memory,
+                    prefetch_factor=prefetch_factor, persistent_workers=persistent_workers)
     
     dragonfly.save(model_outpath)
     
@@ -33,11 +36,17 @@ if __name__ == '__main__':
     parser.add_argument('-e', '--epochs', default=100, type=int)
     parser.add_argument('-b', '--batch-size', default=32, type=int)
     parser.add_argument('-l', '--lr', default=0.0001, type=float)
+    parser.add_argument('--cache', default=None)
+    parser.add_argument('--num-workers', default='4', help='number of DataLoader workers or `auto`')
+    parser.add_argument('--pin-memory', action='store_true')
+    parser.add_argument('--prefetch-factor', default=2, type=int)
+    parser.add_argument('--persistent-workers', action='store_true')
     args = parser.parse_args()
     
     train(args.class_label, args.model_arch, args.model_inpath, args.model_outpath,
           args.traindata, args.validdata,
-          args.epochs, args.batch_size, args.lr)
+          args.epochs, args.batch_size, args.lr, args.cache,
+          args.num_workers, args.pin_memory, args.prefetch_factor, args.persistent_workers)
     
 
 
@@ -0,0 +1,937 @@
+import os
+import io
+import json
+import struct
+import logging
+import collections
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import scipy.spatial
+import cv2
+from PIL import Image
+
+
+logging.basicConfig(level = logging.INFO,
+                    format = '[%(asctime)s] %(levelname)s: %(message)s',
+                    datefmt = '%Y-%m-%d %H:%M:%S')
+
+
+# Components shared by `models.py` (PyTorch) and `runtime.py` (exported graphs).
+# This module does not import torch and torchvision, so that the mesh data and
+# the label hierarchy can be used with the exported graphs.
+
+
+# extensions of images to be listed for inference
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+
+# reduction factors of JPEG decoding in the DCT domain
+REDUCED_FLAGS = [(8, cv2.IMREAD_REDUCED_COLOR_8),
+                 (4, cv2.IMREAD_REDUCED_COLOR_4),
+                 (2, cv2.IMREAD_REDUCED_COLOR_2)]
+
+
+
+def n_available_cpus():
+    """
+    Count the CPU cores available to the process, which can be fewer than
+    the cores of the machine if the process is bound to some of them
+    (e.g., by taskset or the CPU limits of containers).
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    
+    return os.cpu_count() or 1
+
+
+
+def load_labels(class_labels_fpath):
+    """
+    Load 1 column file that contains all labels.
+    """
+    
+    class_labels = []
+    
+    with open(class_labels_fpath, 'r') as infh:
+        for class_name in infh:
+            class_name = class_name.replace('\n', '')
+            if class_name != '':
+                class_labels.append(class_name)
+    
+    return tuple(class_labels)
+
+
+
+def list_images(data_path):
+    """
+    List images for inference. A list of image paths is returned as it is,
+    a path to a file is returned as a list of the single file, and images in
+    a directory are listed in the order of the file names.
+    """
+    
+    img_fpaths = []
+    if isinstance(data_path, (list, tuple)):
+        img_fpaths.extend(data_path)
+    elif os.path.isfile(data_path):
+        img_fpaths.append(data_path)
+    else:
+        for fpath in sorted(os.listdir(data_path)):
+            if os.path.splitext(fpath)[1].lower() in IMAGE_EXTENSIONS:
+                img_fpaths.append(os.path.join(data_path, fpath))
+    
+    return img_fpaths
+
+
+
+def collect_predictions(batches, n_images, class_labels, radii=None):
+    """
+    Collect tuples of file names and probabilities yielded by `iter_inference`
+    into a preallocated float32 array. A data frame is returned for a single
+    radius. If a list of radii is given, a tuple of the file names and
+    an array of (n_images, n_radii, n_classes) is returned.
+    """
+    
+    file_names = []
+    radii_shape = (len(radii), ) if radii is not None else ()
+    pred_probs = np.empty((n_images, ) + radii_shape + (len(class_labels), ), dtype=np.float32)
+    
+    i = 0
+    for _file_names, probs in batches:
+        pred_probs[i:(i + probs.shape[0])] = probs
+        file_names.extend(_file_names)
+        i += probs.shape[0]
+    
+    if pred_probs.ndim == 3:
+        return file_names, pred_probs
+    
+    pred_probs = pd.DataFrame(pred_probs, index=file_names, columns=class_labels, copy=False)
+    return pred_probs
+
+
+
+def decode_flag(img_size, target_size):
+    """
+    Choose the largest reduction of JPEG decoding that keeps the longest edge
+    of the image not smaller than the longest edge of `target_size`, since
+    the image is padded to a square and resized to `target_size` afterwards.
+    The image size should be given only for JPEG images.
+    """
+    if target_size is not None and img_size is not None:
+        for scale, flag in REDUCED_FLAGS:
+            if max(img_size) // scale >= max(target_size):
+                return flag
+    
+    return cv2.IMREAD_COLOR
+
+
+
+def imdecode(buf, target_size=None):
+    """
+    Decode an image from the bytes of an image file. The size of JPEG images
+    is read from the header in the same buffer, and they are decoded with the
+    reduction chosen by `decode_flag` if `target_size` is given.
+    """
+    img_size = None
+    if target_size is not None:
+        try:
+            with Image.open(io.BytesIO(buf)) as im:
+                if im.format == 'JPEG':
+                    img_size = im.size
+        except (IOError, SyntaxError):
+            img_size = None
+    
+    return cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), decode_flag(img_size, target_size))
+
+
+
+def pad_resize(x, shape):
+    """
+    Pad an image to a square and resize it, and return it as an array.
+    """
+    h, w, c = x.shape
+    longest_edge = max(h, w)
+    top = 0
+    bottom = 0
+    left = 0
+    right = 0
+    if h < longest_edge:
+        diff_h = longest_edge - h
+        top = diff_h // 2
+        bottom = diff_h - top
+    elif w < longest_edge:
+        diff_w = longest_edge - w
+        left = diff_w // 2
+        right = diff_w - left
+    else:
+        pass
+    
+    x = cv2.copyMakeBorder(x, top, bottom, left, right,
+                           cv2.BORDER_CONSTANT, value=[0, 0, 0])
+    x = cv2.resize(x, shape)
+    
+    return x
+
+
+
+
+
+class npResize():
+    """
+    Pad an image to a square and resize it, and then normalize it into
+    a CHW float32 array. This is the same as the `transforms_valid` of
+    `DragonflyCls` without importing torch and torchvision.
+    """
+
+    def __init__(self, shape=(224, 224), mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        self.shape = shape
+        self.mean = np.array(mean, dtype=np.float32).reshape(3, 1, 1)
+        self.std = np.array(std, dtype=np.float32).reshape(3, 1, 1)
+
+
+    def __call__(self, x):
+        x = pad_resize(x, self.shape)
+        x = x.transpose(2, 0, 1).astype(np.float32) / 255
+        x = (x - self.mean) / self.std
+
+        return x
+
+
+
+
+
+class DragonflyHierarchy():
+    """
+    Derive genus scores from species scores through the label hierarchy.
+    
+    Species labels are named as `Genus_species`, and the score of a genus is
+    the maximum (`max`) of the scores of its species or the probability that
+    at least one of its species is present (`noisyor`).
+    If a file of genus labels is given, the columns are ordered as the file,
+    otherwise they are sorted alphabetically.
+    """
+    
+    def __init__(self, genus_labels=None, rule='max'):
+        if rule not in ['max', 'noisyor']:
+            raise ValueError('Only `max` or `noisyor` can be specified.')
+        
+        self.rule = rule
+        self.genus_labels = None
+        if genus_labels is not None:
+            self.genus_labels = load_labels(genus_labels)
+    
+    
+    def __call__(self, pred_probs):
+        species_genus = np.array([species.split('_')[0] for species in pred_probs.columns])
+        genus_labels = self.genus_labels
+        if genus_labels is None:
+            genus_labels = tuple(sorted(set(species_genus)))
+        
+        species_probs = pred_probs.values
+        genus_probs = np.zeros((species_probs.shape[0], len(genus_labels)), dtype=np.float32)
+        for i, genus in enumerate(genus_labels):
+            is_genus = (species_genus == genus)
+            if not np.any(is_genus):
+                continue
+            if self.rule == 'max':
+                genus_probs[:, i] = species_probs[:, is_genus].max(axis=1)
+            else:
+                genus_probs[:, i] = 1 - np.prod(1 - species_probs[:, is_genus], axis=1)
+        
+        genus_probs = pd.DataFrame(genus_probs, index=pred_probs.index, columns=genus_labels, copy=False)
+        return genus_probs
+        
+        
+
+class DragonflyMesh():
+    
+    # mean earth radius (km), the same value used by geopy.distance.great_circle
+    EARTH_RADIUS = 6371.009
+    
+    # magic number of the binary mesh data
+    MESH_MAGIC = b'DFMESH01'
+    
+    # EXIF tags and TIFF data types (struct format, size) to read GPS coordinates
+    EXIF_IFD = 0x8769
+    GPS_IFD = 0x8825
+    DATETIME_ORIGINAL = 0x9003
+    GPS_LATITUDE_REF = 1
+    GPS_LATITUDE = 2
+    GPS_LONGITUDE_REF = 3
+    GPS_LONGITUDE = 4
+    TIFF_TYPES = {1: ('B', 1), 2: (None, 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8),
+                  7: (None, 1), 9: ('i', 4), 10: ('ii', 8), 13: ('I', 4)}
+    
+    # month bitmask of all months (bit m - 1 is set for month m)
+    ALL_MONTHS = 0x0FFF
+    
+    def __init__(self, mesh, cache_size=0, season=None):
+        self.dragonflymesh = self.__load_meshdata(mesh)
+        if season is not None:
+            self.dragonflymesh['season'] = self.__load_season(season)
+        
+        # LRU cache of presence masks keyed by (third-order mesh code, d)
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+    
+    
+    def __load_meshdata(self, mesh):
+        """
+        Load mesh data from a TSV file or a binary file converted by `save`.
+        
+        The TSV file contains mesh codes in the first column, latitudes and
+        longitudes of grid cells in the second and third columns, and 0/1 presence
+        of each class in the remaining columns.
+        """
+        with open(mesh, 'rb') as infh:
+            magic = infh.read(len(self.MESH_MAGIC))
+        
+        if magic == self.MESH_MAGIC:
+            dmesh = self.__load_meshdata_binary(mesh)
+        else:
+            x = pd.read_csv(mesh, header=0, sep='\t', index_col=0)
+            x.index = x.index.map(str)
+            dmesh = {
+                'codes': np.array(x.index.values, dtype=np.bytes_),
+                'classes': tuple(x.columns[2:]),
+                'grid': x.iloc[:, :2].values.astype(np.float64),
+                'presence': np.packbits(x.iloc[:, 2:].values > 0, axis=1)
+            }
+        
+        # coordinates of grid cells in radians and on the unit sphere, which are
+        # stored in the binary file and memory-mapped
+        if 'xyz' not in dmesh:
+            lat = np.radians(dmesh['grid'][:, 0].astype(np.float64))
+            dmesh['lng'] = np.radians(dmesh['grid'][:, 1].astype(np.float64))
+            dmesh['sin_lat'] = np.sin(lat)
+            dmesh['cos_lat'] = np.cos(lat)
+            dmesh['xyz'] = np.stack([dmesh['cos_lat'] * np.cos(dmesh['lng']),
+                                     dmesh['cos_lat'] * np.sin(dmesh['lng']),
+                                     dmesh['sin_lat']], axis=1)
+        
+        # spatial index for radius queries is built on the first query
+        dmesh['tree'] = None
+        
+        return dmesh
+    
+    
+    def __load_season(self, season):
+        """
+        Load month bitmasks from a TSV file which contains mesh codes in the
+        first column and the bitmasks of classes in the remaining columns.
+        Bit m - 1 of a bitmask is set if the class has been recorded in month m.
+        Bitmasks are stored as uint16 for each pair of a grid cell and a class.
+        Classes present in a cell without any month recorded are treated as
+        present in all months, and bits of absent classes are cleared.
+        """
+        x = pd.read_csv(season, header=0, sep='\t', index_col=0)
+        x.index = x.index.map(str)
+        x = x.reindex(index=self.dragonflymesh['codes'].astype(str),
+                      columns=list(self.dragonflymesh['classes']), fill_value=0)
+        
+        season = x.values.astype(np.uint16)
+        present = np.unpackbits(self.dragonflymesh['presence'], axis=1,
+                                count=len(self.dragonflymesh['classes'])).astype(bool)
+        season[present & (season == 0)] = self.ALL_MONTHS
+        season[~present] = 0
+        
+        return season
+    
+    
+    def __load_meshdata_binary(self, mesh):
+        """
+        Load the binary mesh data. Arrays are memory-mapped and read on demand.
+        """
+        with open(mesh, 'rb') as infh:
+            infh.seek(len(self.MESH_MAGIC))
+            header_size = int(np.frombuffer(infh.read(8), dtype='<u8')[0])
+            header = json.loads(infh.read(header_size).decode('utf-8'))
+        
+        dmesh = {'classes': tuple(header['classes'])}
+        for name, spec in header['arrays'].items():
+            dmesh[name] = np.memmap(mesh, mode='r', dtype=np.dtype(spec['dtype']),
+                                    offset=spec['offset'], shape=tuple(spec['shape']))
+        
+        return dmesh
+    
+    
+    def save(self, mesh_path):
+        """
+        Save the mesh data as a binary file which can be memory-mapped.
+        
+        The file starts with a magic number and a JSON header of array offsets,
+        followed by the mesh codes, float64 grid coordinates, bit-packed
+        presence matrix, uint16 month bitmasks if loaded, and the coordinates
+        of grid cells in radians and on the unit sphere for the distance
+        calculation, each aligned to 64 bytes.
+        """
+        arrays = collections.OrderedDict()
+        for name in ['codes', 'grid', 'presence', 'season', 'lng', 'sin_lat', 'cos_lat', 'xyz']:
+            if name in self.dragonflymesh:
+                arrays[name] = np.ascontiguousarray(self.dragonflymesh[name])
+        
+        # calculate offsets with the header size fixed by an upper bound
+        header = {'classes': list(self.dragonflymesh['classes']), 'arrays': {}}
+        for name, x in arrays.items():
+            header['arrays'][name] = {'dtype': x.dtype.str, 'shape': list(x.shape), 'offset': 0}
+        header_size = len(json.dumps(header).encode('utf-8')) + 32 * len(arrays)
+        offset = len(self.MESH_MAGIC) + 8 + header_size
+        for name, x in arrays.items():
+            offset = (offset + 63) // 64 * 64
+            header['arrays'][name]['offset'] = offset
+            offset += x.nbytes
+        header_bytes = json.dumps(header).encode('utf-8').ljust(header_size)
+        
+        with open(mesh_path, 'wb') as outfh:
+            outfh.write(self.MESH_MAGIC)
+            outfh.write(np.array([header_size], dtype='<u8').tobytes())
+            outfh.write(header_bytes)
+            for name, x in arrays.items():
+                outfh.write(b'\x00' * (header['arrays'][name]['offset'] - outfh.tell()))
+                outfh.write(x.tobytes())
+        
+        logging.info('The mesh data is saved at {}.'.format(mesh_path))
+    
+    
+    def gis2mesh(self, lat, lng, order = 3):
+        return str(int(self.gis2mesh_array(float(lat), float(lng), order)[0]))
+    
+    
+    def gis2mesh_array(self, lat, lng, order=3):
+        """
+        Convert arrays of latitudes and longitudes into int64 JIS mesh codes of
+        the given order (1-3). The arithmetic is the same as the conversion of
+        a single point, evaluated on float64 arrays. Points whose latitude or
+        longitude is missing (NaN) are converted to -1.
+        """
+        lat = np.asarray(lat, dtype=np.float64).reshape(-1)
+        lng = np.asarray(lng, dtype=np.float64).reshape(-1)
+        has_gis = np.isfinite(lat) & np.isfinite(lng)
+        lat = np.where(has_gis, lat, 0.0)
+        lng = np.where(has_gis, lng, 0.0)
+        
+        lat_in_min = lat * 60.0
+        code12 = np.trunc(lat_in_min / 40)
+        lat_rest_in_min = lat_in_min - code12 * 40
+        code5 = np.trunc(lat_rest_in_min / 5)
+        lat_rest_in_min -= code5 * 5
+        code7 = np.trunc(lat_rest_in_min / (5/10))
+        
+        code34 = np.trunc(lng) - 100
+        lng_rest_in_deg = lng - np.trunc(lng)
+        code6 = np.trunc(lng_rest_in_deg * 8)
+        lng_rest_in_deg -= code6 / 8
+        code8 = np.trunc(lng_rest_in_deg / (1/80))
+        
+        code = code12.astype(np.int64) * 100 + code34.astype(np.int64)
+        if order >= 2:
+            code = code * 100 + code5.astype(np.int64) * 10 + code6.astype(np.int64)
+        if order == 3:
+            code = code * 100 + code7.astype(np.int64) * 10 + code8.astype(np.int64)
+        code[~has_gis] = -1
+        
+        return code
+    
+    
+    def mesh2gis(self, codes):
+        """
+        Calculate the centroids of mesh cells from an array of JIS mesh codes.
+        The order of each code (1-3) is determined by the number of digits.
+        Arrays of latitudes and longitudes of the centroids are returned.
+        """
+        codes = np.asarray(codes, dtype=np.int64).reshape(-1)
+        is_order3 = (codes >= 10000000)
+        is_order2 = (codes >= 100000) & ~is_order3
+        
+        code = codes
+        code8 = np.where(is_order3, code % 10, 0)
+        code7 = np.where(is_order3, code // 10 % 10, 0)
+        code = np.where(is_order3, code // 100, code)
+        code6 = np.where(is_order3 | is_order2, code % 10, 0)
+        code5 = np.where(is_order3 | is_order2, code // 10 % 10, 0)
+        code = np.where(is_order3 | is_order2, code // 100, code)
+        code34 = code % 100
+        code12 = code // 100
+        
+        # cell size in minutes of latitude and degrees of longitude
+        lat_size = np.where(is_order3, 0.5, np.where(is_order2, 5.0, 40.0))
+        lng_size = np.where(is_order3, 1 / 80, np.where(is_order2, 1 / 8, 1.0))
+        
+        lat = (code12 * 40 + code5 * 5 + code7 * 0.5 + lat_size / 2) / 60.0
+        lng = code34 + 100 + code6 / 8 + code8 / 80 + lng_size / 2
+        
+        return lat, lng
+    
+    
+    @classmethod
+    def __read_tiff(cls, fh):
+        """
+        Read the TIFF structure of EXIF from the APP1 segment of JPEG or the eXIf
+        chunk of PNG. Only the headers are read, and the image data are skipped.
+        """
+        magic = fh.read(8)
+        
+        if magic[:2] == b'\xff\xd8':
+            fh.seek(2)
+            while True:
+                marker = fh.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                while marker[1] == 0xFF:
+                    marker = marker[1:] + fh.read(1)
+                    if len(marker) < 2:
+                        return None
+                # the image data start at SOS
+                if marker[1] == 0xDA or marker[1] == 0xD9:
+                    return None
+                if marker[1] == 0x01 or 0xD0 <= marker[1] <= 0xD7:
+                    continue
+                segment_size = fh.read(2)
+                if len(segment_size) < 2:
+                    return None
+                segment_size = struct.unpack('>H', segment_size)[0] - 2
+                if marker[1] == 0xE1:
+                    segment = fh.read(segment_size)
+                    if segment[:6] == b'Exif\x00\x00':
+                        return segment[6:]
+                else:
+                    fh.seek(segment_size, 1)
+        
+        elif magic == b'\x89PNG\r\n\x1a\n':
+            while True:
+                chunk = fh.read(8)
+                if len(chunk) < 8:
+                    return None
+                chunk_size, chunk_type = struct.unpack('>I4s', chunk)
+                if chunk_type == b'eXIf':
+                    return fh.read(chunk_size)
+                if chunk_type == b'IEND':
+                    return None
+                fh.seek(chunk_size + 4, 1)
+        
+        return None
+    
+    
+    @classmethod
+    def __parse_ifd(cls, tiff, endian, offset, tags):
+        """
+        Parse the values of the given tags in an IFD of the TIFF structure.
+        Rationals are converted to floats, and ASCII strings are kept as bytes.
+        """
+        entries = {}
+        if offset + 2 > len(tiff):
+            return entries
+        
+        n_entries = struct.unpack_from(endian + 'H', tiff, offset)[0]
+        for i in range(n_entries):
+            entry = offset + 2 + 12 * i
+            if entry + 12 > len(tiff):
+                break
+            tag, dtype, count = struct.unpack_from(endian + 'HHI', tiff, entry)
+            if tag not in tags or dtype not in cls.TIFF_TYPES:
+                continue
+            fmt, size = cls.TIFF_TYPES[dtype]
+            value_offset = entry + 8
+            if size * count > 4:
+                value_offset = struct.unpack_from(endian + 'I', tiff, entry + 8)[0]
+            if value_offset + size * count > len(tiff):
+                continue
+            
+            if fmt is None:
+                entries[tag] = tiff[value_offset:(value_offset + count)]
+            else:
+                values = struct.unpack_from(endian + fmt * count, tiff, value_offset)
+                if dtype == 5 or dtype == 10:
+                    values = tuple(float(n) / d if d != 0 else np.nan for n, d in zip(values[0::2], values[1::2]))
+                entries[tag] = values
+        
+        return entries
+    
+    
+    @classmethod
+    def get_jpeg_info(cls, img_fpath):
+        """
+        Read the capture date, latitude and longitude from EXIF of a JPEG or PNG
+        image. Only the EXIF segment is read and parsed, without decoding
+        the image. The bytes of an image file can be given instead of the path.
+        """
+        lat = None
+        lng = None
+        capture_date = None
+        
+        try:
+            if isinstance(img_fpath, bytes):
+                tiff = cls.__read_tiff(io.BytesIO(img_fpath))
+            else:
+                with open(img_fpath, 'rb') as infh:
+                    tiff = cls.__read_tiff(infh)
+            
+            if tiff is None or tiff[:2] not in [b'II', b'MM']:
+                return (capture_date, lat, lng)
+            endian = '<' if tiff[:2] == b'II' else '>'
+            
+            ifd0 = cls.__parse_ifd(tiff, endian, struct.unpack_from(endian + 'I', tiff, 4)[0],
+                                   [cls.EXIF_IFD, cls.GPS_IFD])
+            
+            # pointers to IFDs are LONG or IFD (13) with a single value
+            if len(ifd0.get(cls.GPS_IFD, ())) == 1:
+                gps = cls.__parse_ifd(tiff, endian, ifd0[cls.GPS_IFD][0],
+                                      [cls.GPS_LATITUDE_REF, cls.GPS_LATITUDE, cls.GPS_LONGITUDE_REF, cls.GPS_LONGITUDE])
+                if len(gps) == 4 and len(gps[cls.GPS_LATITUDE]) == 3 and len(gps[cls.GPS_LONGITUDE]) == 3:
+                    lat_sign = {b'N': 1.0, b'S': -1.0}.get(gps[cls.GPS_LATITUDE_REF][:1])
+                    lon_sign = {b'E': 1.0, b'W': -1.0}.get(gps[cls.GPS_LONGITUDE_REF][:1])
+                    if lat_sign is not None and lon_sign is not None:
+                        lat = gps[cls.GPS_LATITUDE]
+                        lon = gps[cls.GPS_LONGITUDE]
+                        lat = lat_sign * (lat[0] + lat[1] / 60 + lat[2] / 3600)
+                        lng = lon_sign * (lon[0] + lon[1] / 60 + lon[2] / 3600)
+            
+            if len(ifd0.get(cls.EXIF_IFD, ())) == 1:
+                exif = cls.__parse_ifd(tiff, endian, ifd0[cls.EXIF_IFD][0], [cls.DATETIME_ORIGINAL])
+                if cls.DATETIME_ORIGINAL in exif:
+                    capture_date = exif[cls.DATETIME_ORIGINAL].split(b'\x00')[0].decode('ascii', 'ignore')
+                    capture_date = capture_date.split(' ')[0].replace(':', '-')
+        
+        except (IOError, struct.error, IndexError, ValueError):
+            pass
+        
+        return (capture_date, lat, lng)
+    
+    
+    def read_gis(self, img_fpaths, n_jobs=4):
+        """
+        Read the latitudes, longitudes and capture dates of images with `n_jobs`
+        threads. Float64 arrays of latitudes and longitudes (NaN if missing)
+        and a datetime64 array of capture dates (NaT if missing) are returned.
+        """
+        lat = np.full(len(img_fpaths), np.nan, dtype=np.float64)
+        lng = np.full(len(img_fpaths), np.nan, dtype=np.float64)
+        capture_dates = np.full(len(img_fpaths), np.datetime64('NaT'), dtype='datetime64[D]')
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(int(n_jobs), 1)) as executor:
+            for i, (capture_date, _lat, _lng) in enumerate(executor.map(self.get_jpeg_info, img_fpaths)):
+                if _lat is not None and _lng is not None:
+                    lat[i] = _lat
+                    lng[i] = _lng
+                if capture_date:
+                    try:
+                        capture_dates[i] = np.datetime64(capture_date, 'D')
+                    except ValueError:
+                        pass
+        
+        return lat, lng, capture_dates
+    
+    
+    def __calc_dist(self, lat, lng, idx):
+        """
+        Calculate great-circle distances (km) between a query point and the grid cells.
+        
+        The formula is the same as `geopy.distance.great_circle`, evaluated on
+        numpy arrays; the distances agree with geopy within 1e-6 km, as the grid
+        coordinates are kept in float64.
+        The query point is given in radians and `idx` specifies the grid cells.
+        """
+        sin_lat1 = self.dragonflymesh['sin_lat'][idx]
+        cos_lat1 = self.dragonflymesh['cos_lat'][idx]
+        sin_lat2 = np.sin(lat)
+        cos_lat2 = np.cos(lat)
+        delta_lng = lng - self.dragonflymesh['lng'][idx]
+        cos_delta_lng = np.cos(delta_lng)
+        sin_delta_lng = np.sin(delta_lng)
+        
+        d = np.arctan2(np.sqrt((cos_lat2 * sin_delta_lng) ** 2 +
+                               (cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_delta_lng) ** 2),
+                       sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_delta_lng)
+        
+        return self.EARTH_RADIUS * d
+    
+    
+    def __query_ball(self, gis, d):
+        """
+        Find candidate grid cells within `d` km from each query point with the
+        spatial index. The great-circle distance `d` is converted to the chord
+        length on the unit sphere and slightly enlarged so that no cells on the
+        boundary are missed; the exact distances are checked afterwards.
+        """
+        xyz = np.stack([np.cos(gis[:, 0]) * np.cos(gis[:, 1]),
+                        np.cos(gis[:, 0]) * np.sin(gis[:, 1]),
+                        np.sin(gis[:, 0])], axis=1)
+        r = 2.0 * np.sin(min(d / self.EARTH_RADIUS, np.pi) / 2.0) * (1.0 + 1e-9) + 1e-12
+        
+        if self.dragonflymesh['tree'] is None:
+            self.dragonflymesh['tree'] = scipy.spatial.cKDTree(self.dragonflymesh['xyz'])
+        
+        return self.dragonflymesh['tree'].query_ball_point(xyz, r)
+        
+    
+    @staticmethod
+    def radii(d):
+        """
+        Normalize the radius argument. A list of radii is returned if several
+        radii are given as a list, tuple or array, otherwise None is returned
+        for a single radius.
+        """
+        if np.ndim(d) > 0:
+            return np.asarray(d).reshape(-1).tolist()
+        return None
+    
+    
+    def __mask_shape(self, d):
+        """
+        Shape of the presence mask of a point; (n_radii, n_classes) if a list
+        of radii is given, otherwise (n_classes, ).
+        """
+        radii = self.radii(d)
+        if radii is not None:
+            return (len(radii), len(self.dragonflymesh['classes']))
+        return (len(self.dragonflymesh['classes']), )
+    
+    
+    def __predict(self, gis, d=100):
+        """
+        Calculate presence masks for a batch of (lat, lng) points.
+        
+        A class is present (1) at a point if it has been recorded at any grid cell
+        within `d` km from the point, otherwise absent (0).
+        The result has the shape of (n_queries, n_classes).
+        
+        If a list of radii is given, the grid cells are queried once within the
+        largest radius and grouped by the smallest radius that contains them.
+        The cells of each group are ORed with `reduceat`, and the masks of all
+        radii are the cumulative OR of the groups. The result has the shape of
+        (n_queries, n_radii, n_classes).
+        
+        If the month bitmasks are loaded, the bitmasks ORed over the grid cells
+        are returned as uint16 instead of 0/1.
+        """
+        gis = np.radians(np.asarray(gis, dtype=np.float64).reshape(-1, 2))
+        radii = np.asarray(d, dtype=np.float64).reshape(-1)
+        radii_order = np.argsort(radii, kind='stable')
+        sorted_radii = radii[radii_order]
+        n_classes = len(self.dragonflymesh['classes'])
+        if 'season' in self.dragonflymesh:
+            cells = self.dragonflymesh['season']
+        else:
+            cells = self.dragonflymesh['presence']
+        output = np.zeros((gis.shape[0], radii.shape[0], cells.shape[1]), dtype=cells.dtype)
+        
+        for i, idx in enumerate(self.__query_ball(gis, radii.max())):
+            idx = np.asarray(idx, dtype=np.int64)
+            if idx.shape[0] == 0:
+                continue
+            dist = self.__calc_dist(gis[i, 0], gis[i, 1], idx)
+            
+            if radii.shape[0] == 1:
+                idx = idx[dist < radii[0]]
+                if idx.shape[0] > 0:
+                    output[i, 0] = np.bitwise_or.reduce(cells[idx], axis=0)
+            else:
+                # group k contains cells with sorted_radii[k - 1] <= dist < sorted_radii[k]
+                groups = np.searchsorted(sorted_radii, dist, side='right')
+                is_within = (groups < radii.shape[0])
+                idx = idx[is_within]
+                groups = groups[is_within]
+                order = np.argsort(groups, kind='stable')
+                idx = idx[order]
+                groups = groups[order]
+                
+                starts = np.searchsorted(groups, np.arange(radii.shape[0]), side='left')
+                ends = np.searchsorted(groups, np.arange(radii.shape[0]), side='right')
+                is_nonempty = (starts < ends)
+                if not np.any(is_nonempty):
+                    continue
+                group_cells = np.zeros((radii.shape[0], cells.shape[1]), dtype=cells.dtype)
+                group_cells[is_nonempty] = np.bitwise_or.reduceat(cells[idx], starts[is_nonempty], axis=0)
+                output[i, radii_order] = np.bitwise_or.accumulate(group_cells, axis=0)
+        
+        if 'season' not in self.dragonflymesh:
+            output = np.unpackbits(output, axis=2, count=n_classes).astype(np.float32)
+        
+        return output.reshape((gis.shape[0], ) + self.__mask_shape(d))
+    
+    
+    def __in_mesh_domain(self, lat, lng):
+        """
+        Check whether points lie in the domain of the JIS mesh codes, i.e.,
+        the two-digit latitude and longitude codes of first-order cells
+        (0 <= lat < 66.67, 100 <= lng < 200).
+        """
+        return (lat >= 0) & (lat * 1.5 < 100) & (lng >= 100) & (lng < 200)
+    
+    
+    def __cached_predict(self, gis, d=100):
+        """
+        Calculate presence masks through the LRU cache.
+        
+        Query points are quantized to third-order mesh cells (about 1 km square)
+        and the mask is calculated once from the centroid of each cell.
+        Only points inside the domain of the JIS mesh codes are cached; the
+        codes of the other points do not decode to the original location
+        (e.g., Paris falls in Mongolia), so their masks are calculated directly.
+        """
+        output = np.zeros((gis.shape[0], ) + self.__mask_shape(d),
+                          dtype=(np.uint16 if 'season' in self.dragonflymesh else np.float32))
+        in_domain = self.__in_mesh_domain(gis[:, 0], gis[:, 1])
+        if not np.all(in_domain):
+            output[~in_domain] = self.__predict(gis[~in_domain], d)
+            if not np.any(in_domain):
+                return output
+        
+        codes = self.gis2mesh_array(gis[in_domain, 0], gis[in_domain, 1], 3).tolist()
+        if self.radii(d) is not None:
+            d = tuple(self.radii(d))
+        
+        missed_codes = collections.OrderedDict()
+        for code in codes:
+            if (code, d) in self.cache:
+                self.cache.move_to_end((code, d))
+                self.cache_hits += 1
+            else:
+                missed_codes[code] = None
+                self.cache_misses += 1
+        
+        missed_masks = {}
+        if len(missed_codes) > 0:
+            missed_codes = list(missed_codes.keys())
+            masks = self.__predict(np.stack(self.mesh2gis(missed_codes), axis=1), d)
+            missed_masks = dict(zip(missed_codes, masks))
+        
+        cached_output = np.empty((len(codes), ) + output.shape[1:], dtype=output.dtype)
+        for i, code in enumerate(codes):
+            if code in missed_masks:
+                cached_output[i] = missed_masks[code]
+            else:
+                cached_output[i] = self.cache[(code, d)]
+        output[in_domain] = cached_output
+        
+        for code, mask in missed_masks.items():
+            self.cache[(code, d)] = mask
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        
+        return output
+    
+    
+    def cache_info(self):
+        return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                'size': len(self.cache), 'maxsize': self.cache_size}
+    
+    
+    def capture_month(self, capture_dates):
+        """
+        Convert an array of capture dates (datetime64) into months (1-12).
+        Missing dates (NaT) are converted to 0.
+        """
+        capture_dates = np.asarray(capture_dates, dtype='datetime64[D]')
+        month = capture_dates.astype('datetime64[M]').astype(np.int64) % 12 + 1
+        month[np.isnat(capture_dates)] = 0
+        
+        return month
+    
+    
+    def presence(self, lat, lng, d=100, out=None, month=None):
+        """
+        Calculate presence masks for arrays of latitudes and longitudes.
+        
+        Points whose latitude or longitude is missing (None or NaN) are not filtered,
+        i.e., all classes are set to present (1).
+        If `cache_size` is set, the masks are calculated at the centroids of
+        third-order mesh cells and cached.
+        The masks are written into `out` if a float32 array is given.
+        If a list of radii is given as `d`, the masks of all radii are calculated
+        from a single query, and the result has the shape of
+        (n_points, n_radii, n_classes).
+        If the month bitmasks are loaded and an array of capture months (1-12)
+        is given as `month`, a class is present only if it has been recorded
+        in the month. Points whose month is missing (0) are filtered by all months.
+        """
+        lat = np.asarray(lat, dtype=np.float64).reshape(-1)
+        lng = np.asarray(lng, dtype=np.float64).reshape(-1)
+        has_gis = np.isfinite(lat) & np.isfinite(lng)
+        
+        output = out
+        if output is None:
+            output = np.empty((lat.shape[0], ) + self.__mask_shape(d), dtype=np.float32)
+        
+        if 'season' in self.dragonflymesh:
+            months = np.zeros((lat.shape[0], ) + self.__mask_shape(d), dtype=np.uint16)
+            months[~has_gis] = self.ALL_MONTHS
+        else:
+            months = output
+            months[~has_gis] = 1.0
+        
+        if np.any(has_gis):
+            gis = np.stack([lat[has_gis], lng[has_gis]], axis=1)
+            if self.cache_size > 0:
+                months[has_gis] = self.__cached_predict(gis, d)
+            else:
+                months[has_gis] = self.__predict(gis, d)
+        
+        if 'season' in self.dragonflymesh:
+            month_bits = np.full(lat.shape[0], self.ALL_MONTHS, dtype=np.uint16)
+            if month is not None:
+                month = np.asarray(month, dtype=np.int64).reshape(-1)
+                has_month = (month >= 1) & (month <= 12)
+                month_bits[has_month] = np.left_shift(1, month[has_month] - 1)
+            month_bits = month_bits.reshape((-1, ) + (1, ) * (months.ndim - 1))
+            output[...] = np.bitwise_and(months, month_bits) != 0
+        
+        return output
+    
+    
+    def presence_mask(self, lat, lng, class_labels, d=100, month=None):
+        """
+        Calculate presence masks with the columns ordered as `class_labels`,
+        which are multiplied by the probabilities of the image models.
+        Classes which are not included in the mesh data are not filtered.
+        """
+        output = self.presence(lat, lng, d, month=month)
+        if tuple(class_labels) == tuple(self.dragonflymesh['classes']):
+            return output
+        
+        class_idx = {class_label: i for i, class_label in enumerate(self.dragonflymesh['classes'])}
+        mask = np.ones(output.shape[:-1] + (len(class_labels), ), dtype=np.float32)
+        for i, class_label in enumerate(class_labels):
+            if class_label in class_idx:
+                mask[..., i] = output[..., class_idx[class_label]]
+        
+        return mask
+    
+    
+    def filter_probs(self, probs, lat, lng, class_labels, d=100, month=None):
+        """
+        Multiply the probabilities of the image models (n_images, n_classes) by
+        the presence masks. If a list of radii is given, the probabilities are
+        broadcast to the shape of (n_images, n_radii, n_classes).
+        """
+        mask = self.presence_mask(lat, lng, class_labels, d, month=month)
+        if mask.ndim == 3:
+            probs = probs[:, np.newaxis, :]
+        
+        return probs * mask
+    
+    
+    
+    def inference(self, data_path, d=100, n_jobs=4):
+        """
+        Calculate presence masks of images from the GPS coordinates in EXIF.
+        A data frame is returned for a single radius. If a list of radii is
+        given, a tuple of the file names and a float32 array of the shape
+        (n_images, n_radii, n_classes) is returned.
+        """
+        dataset = list_images(data_path)
+        
+        lat, lng, capture_dates = self.read_gis(dataset, n_jobs)
+        
+        pred_scores = np.empty((len(dataset), ) + self.__mask_shape(d), dtype=np.float32)
+        self.presence(lat, lng, d, out=pred_scores, month=self.capture_month(capture_dates))
+        if self.cache_size > 0:
+            logging.info('Mesh cache: hits {}; misses {}.'.format(self.cache_hits, self.cache_misses))
+        
+        if pred_scores.ndim == 3:
+            return dataset, pred_scores
+        
+        pred_scores = pd.DataFrame(pred_scores, index=dataset,
+                                   columns=self.dragonflymesh['classes'], copy=False)
+        return pred_scores